@@ -0,0 +1,636 @@
+"""load_benchmark.py - measure latency, throughput and memory of hub, channel and client.
+
+The three apps are started as local processes, each in a temporary working
+directory, next to a stub server standing in for Open-Meteo and for further
+channels registered with the hub. After preloading a message history, a
+weighted mix of requests is sent from concurrent threads for a fixed time.
+The report lists p50/p95/p99 latency and throughput per operation and the
+memory of every app. Afterwards the message list of the channel and the
+channel list of the hub are requested without compression, with gzip and
+with brotli, to compare sizes and latencies. Results can be saved as JSON
+and compared with the results of an earlier run (e.g. of another commit).
+
+Operations: read (GET / of the channel), poll (GET /?since=), write and
+command (POST / with a message or "!weather <place>"), channels (GET
+/channels of the hub), check (check_channels of the hub), show (GET /show
+of the client) and overview (GET /channels/overview of the client).
+
+Run from the repository root:
+
+    > python benchmarks/load_benchmark.py --duration 10 --output before.json
+    > python benchmarks/load_benchmark.py --duration 10 --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HUB_AUTHKEY = "benchmark-hub"
+CHANNEL_AUTHKEY = "benchmark-channel"
+APPS = ("stub", "hub", "channel", "client")
+OPERATIONS = (
+    "read",
+    "poll",
+    "write",
+    "command",
+    "channels",
+    "check",
+    "show",
+    "overview",
+)
+ENCODINGS = ("identity", "gzip", "br")
+WORDS = "the weather is nice today but it will rain tomorrow in the north".split()
+
+
+def stub_app(latency: float):
+    """Create the stub server of Open-Meteo and of additional channels.
+
+    Args:
+        latency (float): seconds every Open-Meteo request takes
+
+    Returns:
+        flask.Flask: the stub app
+
+    """
+    from flask import Flask, jsonify, request
+
+    app = Flask("stub")
+    counts = {"geocoding": 0, "weather": 0}
+
+    @app.route("/v1/search")
+    def geocoding():
+        counts["geocoding"] += 1
+        time.sleep(latency)
+        seed = sum(map(ord, request.args.get("name", "")))
+        return jsonify(results=[{"latitude": seed % 90, "longitude": seed % 180}])
+
+    @app.route("/v1/forecast")
+    def weather():
+        counts["weather"] += 1
+        time.sleep(latency)
+        return jsonify(current_weather={"temperature": 12.5, "windspeed": 3.5})
+
+    @app.route("/channel/<int:number>/health")
+    def channel_health(number):
+        return jsonify(name=f"Stub {number}")
+
+    @app.route("/channel/<int:number>", methods=["GET", "HEAD"])
+    def channel_messages(number):
+        return jsonify([])
+
+    @app.route("/counts")
+    def get_counts():
+        return jsonify(counts)
+
+    return app
+
+
+def serve(name: str, port: int, options: dict) -> None:
+    """Run one of the apps (in a child process) until it is terminated.
+
+    Args:
+        name (str): "stub", "hub", "channel" or "client"
+        port (int): port to listen on
+        options (dict): URLs of the other apps and settings of the run
+
+    """
+    from flask import jsonify
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    workdir = options["workdir"]
+    os.chdir(workdir)
+    if name == "stub":
+        app = stub_app(options["stub_latency"])
+    elif name == "hub":
+        import flask
+
+        # keep the database of the run out of the repository's instance folder
+        flask.Flask.auto_find_instance_path = lambda self: workdir
+        import hub
+
+        hub.SERVER_AUTHKEY = HUB_AUTHKEY
+        app = hub.app
+        with app.app_context():
+            hub.migrate_database()
+        hub.warm_up()
+
+        @app.route("/benchmark/check_channels")
+        def check_channels():
+            return jsonify(hub.check_all_channels())
+
+    elif name == "channel":
+        import channel
+
+        channel.HUB_URL = options["hub"]
+        channel.CHANNEL_AUTHKEY = CHANNEL_AUTHKEY
+        channel.CHANNEL_NAME = "Benchmark"
+        channel.CHANNEL_STORE = options["store"]
+        channel.CHANNEL_FILE = os.path.join(workdir, "messages.json")
+        channel.CHANNEL_LOG_FILE = os.path.join(workdir, "messages.ndjson")
+        channel.CHANNEL_DB_FILE = os.path.join(workdir, "messages.sqlite3")
+        channel.GEOCODING_URL = options["stub"] + "/v1/search"
+        channel.WEATHER_URL = options["stub"] + "/v1/forecast"
+        channel.warm_up()
+        app = channel.app
+    else:
+        import client
+
+        client.HUB_URL = options["hub"]
+        client.HUB_AUTHKEY = HUB_AUTHKEY
+        client.warm_up()
+        app = client.app
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def free_port() -> int:
+    """Return a free TCP port on localhost.
+
+    Returns:
+        int: the port
+
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_apps(workdir: str, args) -> dict:
+    """Start all apps in child processes and wait until they accept connections.
+
+    Args:
+        workdir (str): directory for the working directories of the apps
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        dict: app name -> (subprocess.Popen, URL)
+
+    """
+    ports = {name: free_port() for name in APPS}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+    apps = {}
+    for name in APPS:
+        directory = os.path.join(workdir, name)
+        os.mkdir(directory)
+        options = dict(
+            urls, workdir=directory, store=args.store, stub_latency=args.stub_latency
+        )
+        with open(os.path.join(directory, "server.log"), "w") as log:
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--serve",
+                    name,
+                    "--port",
+                    str(ports[name]),
+                    "--options",
+                    json.dumps(options),
+                ],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        apps[name] = (process, urls[name])
+    for name, (process, url) in apps.items():
+        deadline = time.monotonic() + 30
+        while True:
+            if process.poll() is not None:
+                with open(os.path.join(workdir, name, "server.log")) as f:
+                    sys.exit(f"{name} failed to start:\n{f.read()[-2000:]}")
+            try:
+                socket.create_connection(("127.0.0.1", ports[name]), 0.2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    sys.exit(f"{name} did not start in time")
+                time.sleep(0.1)
+    return apps
+
+
+def prepare(urls: dict, args) -> dict:
+    """Register the channels with the hub and preload the message history.
+
+    Args:
+        urls (dict): app name -> URL
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        dict: shared state of the operations
+
+    """
+    hub_headers = {"Authorization": "authkey " + HUB_AUTHKEY}
+    channels = [
+        {"name": "Benchmark", "endpoint": urls["channel"], "authkey": CHANNEL_AUTHKEY}
+    ]
+    channels += [
+        {"name": f"Stub {n}", "endpoint": f"{urls['stub']}/channel/{n}", "authkey": "-"}
+        for n in range(1, args.channels)
+    ]
+    for channel in channels:
+        response = requests.post(
+            urls["hub"] + "/channels",
+            json=dict(channel, type_of_service="aiweb24:chat"),
+            headers=hub_headers,
+        )
+        if response.status_code != 200:
+            sys.exit(f"Registering {channel['endpoint']} failed: {response.text}")
+    headers = {"Authorization": "authkey " + CHANNEL_AUTHKEY}
+    for start in range(0, args.history, 1000):
+        end = min(start + 1000, args.history)
+        batch = [make_message(random.Random(i)) for i in range(start, end)]
+        response = requests.post(urls["channel"], json=batch, headers=headers)
+        if response.status_code != 200:
+            sys.exit(f"Preloading the history failed: {response.text}")
+    return {"urls": urls, "headers": headers, "hub_headers": hub_headers, "last_id": 0}
+
+
+def make_message(rng: random.Random, content=None) -> dict:
+    """Create a chat message.
+
+    Args:
+        rng (random.Random): random number generator
+        content (str): the content, random words by default
+
+    Returns:
+        dict: the message
+
+    """
+    return {
+        "content": content or " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+        "sender": f"user{rng.randint(1, 50)}",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def operation(name: str, session: requests.Session, state: dict, rng, args):
+    """Send the request of an operation.
+
+    Args:
+        name (str): the operation
+        session (requests.Session): session of the calling thread
+        state (dict): shared state of the operations
+        rng (random.Random): random number generator of the calling thread
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        requests.Response: the response
+
+    """
+    urls = state["urls"]
+    if name == "read":
+        response = session.get(urls["channel"], headers=state["headers"])
+    elif name == "poll":
+        since = max(state["last_id"] - 10, 0)
+        response = session.get(
+            urls["channel"], params={"since": since}, headers=state["headers"]
+        )
+    elif name in ("write", "command"):
+        content = None
+        if name == "command":
+            content = f"!weather Place {rng.randrange(args.places)}"
+        response = session.post(
+            urls["channel"], json=make_message(rng, content), headers=state["headers"]
+        )
+    elif name == "channels":
+        response = session.get(urls["hub"] + "/channels")
+    elif name == "check":
+        response = session.get(urls["hub"] + "/benchmark/check_channels")
+    elif name == "show":
+        response = session.get(urls["client"] + "/show?channel=" + urls["channel"])
+    else:
+        response = session.get(urls["client"] + "/channels/overview?messages=5")
+    if "X-Last-Id" in response.headers:
+        state["last_id"] = int(response.headers["X-Last-Id"])
+    return response
+
+
+def run_load(state: dict, args) -> tuple:
+    """Send the operation mix from concurrent threads.
+
+    Args:
+        state (dict): shared state of the operations
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        tuple: operation -> list of latencies, operation -> number of
+            errors and the measured seconds
+
+    """
+    mix = dict(item.split("=") for item in args.mix.split(","))
+    names = list(mix)
+    weights = [float(mix[name]) for name in names]
+    for name in names:
+        if name not in OPERATIONS:
+            sys.exit(f"Unknown operation {name}, choose from {', '.join(OPERATIONS)}")
+    start = time.monotonic() + args.warmup
+    deadline = start + args.duration
+    results = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        latencies = {name: [] for name in names}
+        errors = dict.fromkeys(names, 0)
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            name = rng.choices(names, weights)[0]
+            begin = time.perf_counter()
+            try:
+                ok = operation(name, session, state, rng, args).status_code < 400
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - begin
+            if now < start:
+                continue  # warm-up
+            latencies[name].append(elapsed)
+            if not ok:
+                errors[name] += 1
+        results.append((latencies, errors))
+
+    threads = [
+        threading.Thread(target=worker, args=(args.seed + i,))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+    for thread_latencies, thread_errors in results:
+        for name in names:
+            latencies[name] += thread_latencies[name]
+            errors[name] += thread_errors[name]
+    return latencies, errors, args.duration
+
+
+def measure_encodings(state: dict, args) -> dict:
+    """Request the message and channel lists in every content encoding.
+
+    Args:
+        state (dict): shared state of the operations
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        dict: list -> encoding -> served encoding, body bytes on the wire and
+            latency percentiles (ms)
+
+    """
+    urls = state["urls"]
+    targets = {
+        "messages": (urls["channel"], state["headers"]),
+        "channels": (urls["hub"] + "/channels", {}),
+    }
+    results = {}
+    session = requests.Session()
+    for target, (url, headers) in targets.items():
+        results[target] = {}
+        for encoding in ENCODINGS:
+            latencies = []
+            for _ in range(args.encoding_requests):
+                begin = time.perf_counter()
+                response = session.get(
+                    url,
+                    headers=dict(headers, **{"Accept-Encoding": encoding}),
+                    stream=True,
+                )
+                size = len(response.raw.read(decode_content=False))
+                latencies.append(time.perf_counter() - begin)
+            stats = summarize(latencies, 0, sum(latencies))
+            results[target][encoding] = {
+                "served": response.headers.get("Content-Encoding", "identity"),
+                "bytes": size,
+                "p50_ms": stats["p50_ms"],
+                "p95_ms": stats["p95_ms"],
+            }
+    return results
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Return a percentile of sorted values (nearest rank).
+
+    Args:
+        values (list): sorted values
+        fraction (float): the percentile, e.g. 0.95
+
+    Returns:
+        float: the value, None if there are no values
+
+    """
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(latencies: list, errors: int, seconds: float) -> dict:
+    """Summarize the latencies of an operation.
+
+    Args:
+        latencies (list): latencies in seconds
+        errors (int): number of failed requests
+        seconds (float): measured seconds
+
+    Returns:
+        dict: requests, errors, throughput and latency percentiles (ms)
+
+    """
+    values = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput": round(len(values) / seconds, 2),
+        "mean_ms": ms(sum(values) / len(values) if values else None),
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p95_ms": ms(percentile(values, 0.95)),
+        "p99_ms": ms(percentile(values, 0.99)),
+    }
+
+
+def memory(pid: int) -> dict:
+    """Return the current and peak resident memory of a process (Linux only).
+
+    Args:
+        pid (int): the process id
+
+    Returns:
+        dict: rss_mb and peak_mb, None where unavailable
+
+    """
+    result = {"rss_mb": None, "peak_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    mb = round(int(value.split()[0]) / 1024, 1)
+                    result["rss_mb" if key == "VmRSS" else "peak_mb"] = mb
+    except OSError:
+        pass
+    return result
+
+
+def git_commit() -> str:
+    """Return the commit of the working tree.
+
+    Returns:
+        str: the commit hash, None outside of a git repository
+
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict, baseline=None) -> None:
+    """Print the results, with the change relative to a baseline if given.
+
+    Args:
+        report (dict): results of this run
+        baseline (dict): results of an earlier run
+
+    """
+
+    def change(name, key, value):
+        old = (baseline or {}).get("operations", {}).get(name, {}).get(key)
+        if not old or value is None:
+            return ""
+        return f" ({(value - old) / old:+.0%})"
+
+    print(
+        f"{'operation':<10} {'requests':>9} {'errors':>7} {'req/s':>16} "
+        f"{'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}"
+    )
+    for name, stats in report["operations"].items():
+        columns = [
+            f"{stats[key]}{change(name, key, stats[key])}"
+            for key in ("throughput", "p50_ms", "p95_ms", "p99_ms")
+        ]
+        print(
+            f"{name:<10} {stats['requests']:>9} {stats['errors']:>7} "
+            + " ".join(f"{c:>16}" for c in columns)
+        )
+    for name, stats in report["memory"].items():
+        print(f"{name:<10} rss {stats['rss_mb']} MB, peak {stats['peak_mb']} MB")
+    print(f"{'list':<10} {'encoding':<9} {'served':<9} {'bytes':>10} {'p50 ms':>8}")
+    for target, encodings in report.get("encodings", {}).items():
+        identity = encodings["identity"]["bytes"]
+        for encoding, stats in encodings.items():
+            ratio = f" ({stats['bytes'] / identity:.0%})" if identity else ""
+            print(
+                f"{target:<10} {encoding:<9} {stats['served']:<9} "
+                f"{stats['bytes']:>10}{ratio} {stats['p50_ms']:>8}"
+            )
+    print(f"Open-Meteo requests: {report['open_meteo_requests']}")
+
+
+def main():
+    """Run the benchmark, print the report and save it."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--mix",
+        default="read=40,poll=20,write=20,command=5,channels=5,show=5,overview=5",
+        help="weights of the operations",
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--duration", type=float, default=10, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds not measured")
+    parser.add_argument("--history", type=int, default=1000, help="preloaded messages")
+    parser.add_argument("--channels", type=int, default=10, help="channels at the hub")
+    parser.add_argument("--places", type=int, default=20, help="places of !weather")
+    parser.add_argument(
+        "--stub-latency", type=float, default=0.05, help="seconds per Open-Meteo call"
+    )
+    parser.add_argument("--store", choices=("log", "json", "sqlite"), default="log")
+    parser.add_argument(
+        "--encoding-requests", type=int, default=20, help="requests per encoding"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    parser.add_argument("--serve", choices=APPS, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--options", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, json.loads(args.options))
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        apps = start_apps(workdir, args)
+        try:
+            urls = {name: url for name, (_, url) in apps.items()}
+            state = prepare(urls, args)
+            latencies, errors, seconds = run_load(state, args)
+            encodings = measure_encodings(state, args)
+            report = {
+                "commit": git_commit(),
+                "time": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "settings": {
+                    key: value
+                    for key, value in vars(args).items()
+                    if key not in ("output", "compare", "serve", "port", "options")
+                },
+                "operations": {
+                    name: summarize(latencies[name], errors[name], seconds)
+                    for name in latencies
+                },
+                "total": summarize(
+                    [v for values in latencies.values() for v in values],
+                    sum(errors.values()),
+                    seconds,
+                ),
+                "memory": {
+                    name: memory(process.pid)
+                    for name, (process, _) in apps.items()
+                    if name != "stub"
+                },
+                "open_meteo_requests": requests.get(urls["stub"] + "/counts").json(),
+                "encodings": encodings,
+            }
+        finally:
+            for process, _ in apps.values():
+                process.terminate()
+            for process, _ in apps.values():
+                process.wait()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
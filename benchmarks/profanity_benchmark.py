@@ -0,0 +1,108 @@
+"""profanity_benchmark.py - compare ProfanityFilter with better_profanity's censor.
+
+Run from the repository root:
+
+    > python benchmarks/profanity_benchmark.py
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from better_profanity import profanity  # noqa: E402
+from profanity_filter import ProfanityFilter  # noqa: E402
+
+VOCABULARY = (
+    "the weather is nice today in Berlin but it will rain tomorrow, "
+    "what do you think? I'd rather stay at home and read a book. "
+    "!weather Osnabrück is it sunny over there?"
+).split(" ")
+LEET = {"a": "@4", "i": "1", "o": "0", "e": "3", "s": "$5", "t": "7"}
+
+
+def make_message(words: int, swear_words: list, rng: random.Random) -> str:
+    """Create a chat message, about 1 in 20 words is a (disguised) swear word.
+
+    Args:
+        words (int): number of words
+        swear_words (list): swear words to sprinkle in
+        rng (random.Random): random number generator
+
+    Returns:
+        str: the message
+
+    """
+    result = []
+    for _ in range(words):
+        if rng.random() < 0.05:
+            word = rng.choice(swear_words)
+            word = "".join(
+                rng.choice(LEET[c]) if c in LEET and rng.random() < 0.3 else c
+                for c in word
+            )
+        else:
+            word = rng.choice(VOCABULARY)
+        result.append(word)
+    return " ".join(result)
+
+
+def measure(censor, messages: list, min_time: float) -> float:
+    """Return the number of censored messages per second.
+
+    Args:
+        censor (callable): the censor function
+        messages (list): messages to censor
+        min_time (float): minimum seconds to measure
+
+    Returns:
+        float: messages per second
+
+    """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for message in messages:
+            censor(message)
+        count += len(messages)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def main():
+    """Run the benchmark and print a table of the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="5,20,100,500", help="words per message")
+    parser.add_argument("--messages", type=int, default=20, help="messages per size")
+    parser.add_argument("--time", type=float, default=1.0, help="seconds per run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    fast = ProfanityFilter.from_profanity()
+    print(f"compiled filter in {(time.perf_counter() - start) * 1000:.1f} ms")
+    swear_words = [str(w) for w in profanity.CENSOR_WORDSET if " " not in str(w)]
+
+    print(
+        f"{'words':>6} {'better_profanity/s':>20} {'ProfanityFilter/s':>20} {'speedup':>8}"
+    )
+    for size in (int(s) for s in args.sizes.split(",")):
+        messages = [make_message(size, swear_words, rng) for _ in range(args.messages)]
+        for message in messages:
+            if profanity.censor(message) != fast.censor(message):
+                sys.exit(f"Results differ for {message!r}")
+        slow_rate = measure(profanity.censor, messages, args.time)
+        fast_rate = measure(fast.censor, messages, args.time)
+        print(
+            f"{size:>6} {slow_rate:>20.1f} {fast_rate:>20.1f} "
+            f"{fast_rate / slow_rate:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""startup_benchmark.py - measure import time and time-to-first-response of hub, channel and client.
+
+Every app is started in fresh interpreters, each in a temporary working
+directory, as a WSGI worker would be: a run imports the app module, calls its
+warm_up (as the .wsgi files do) and sends the first and a second request
+through the app's test client. Runs without warm_up show what the first
+request of a worker costs without it. The hub's database is created with
+migrate_database before (and not counted as startup), the channel starts with
+a preloaded message history and the client with a stub hub.
+
+The report lists the medians per app, the heaviest imports of the app module
+and the modules imported later (by warm_up or the first request), taken from
+``python -X importtime``. Results can be saved as JSON and compared with the
+results of an earlier run (e.g. of another commit).
+
+Run from the repository root:
+
+    > python benchmarks/startup_benchmark.py --runs 5 --output before.json
+    > python benchmarks/startup_benchmark.py --runs 5 --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APPS = ("hub", "channel", "client")
+PHASES = ("import", "warm_up", "first_response", "second_response")
+TOP_IMPORTS = 8  # heaviest imports listed per app
+BENCHMARK_IMPORTS = {"flask.testing"}  # imported by the test client, not the app
+
+
+def run(name: str, workdir: str, warm_up: bool, options: dict) -> dict:
+    """Start one of the apps and time it (in a child process).
+
+    Args:
+        name (str): "hub", "channel" or "client"
+        workdir (str): working directory of the run
+        warm_up (bool): call the app's warm_up before the first request
+        options (dict): settings of the run
+
+    Returns:
+        dict: seconds of every phase
+
+    """
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    start = time.perf_counter()
+    import flask
+
+    # keep the database of the run out of the repository's instance folder
+    flask.Flask.auto_find_instance_path = lambda self: workdir
+    app_module = __import__(name)
+    seconds = {"import": time.perf_counter() - start}
+    if name == "hub":
+        with app_module.app.app_context():
+            app_module.migrate_database()
+            for n in range(options["channels"]):
+                app_module.db.session.add(
+                    app_module.Channel(
+                        name=f"Channel {n}",
+                        endpoint=f"http://127.0.0.1:9/channel/{n}",
+                        authkey="-",
+                        type_of_service="aiweb24:chat",
+                    )
+                )
+            app_module.db.session.commit()
+        path, headers = "/channels", {}
+    elif name == "channel":
+        app_module.CHANNEL_STORE = "log"
+        app_module.CHANNEL_LOG_FILE = os.path.join(workdir, "messages.ndjson")
+        app_module.CHANNEL_FILE = os.path.join(workdir, "messages.json")
+        path = "/"
+        headers = {"Authorization": "authkey " + app_module.CHANNEL_AUTHKEY}
+    else:
+        app_module.HUB_URL = start_stub_hub()
+        app_module.CHANNELS_SUBSCRIBE = False
+        app_module.CHANNEL_INDEX.subscribe = False
+        path, headers = "/", {}
+    if warm_up:
+        start = time.perf_counter()
+        app_module.warm_up()
+        seconds["warm_up"] = time.perf_counter() - start
+    client = app_module.app.test_client()
+    for phase in ("first_response", "second_response"):
+        start = time.perf_counter()
+        response = client.get(path, headers=headers)
+        seconds[phase] = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {path} of {name}: {response.status_code}")
+    return seconds
+
+
+def start_stub_hub() -> str:
+    """Serve an empty channel directory in a background thread.
+
+    Returns:
+        str: URL of the stub hub
+
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"version": 0, "reset": True, "channels": []}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def preload_messages(workdir: str, count: int) -> None:
+    """Write a message history to the log of the channel.
+
+    Args:
+        workdir (str): working directory of the run
+        count (int): number of messages
+
+    """
+    sys.path.insert(0, ROOT)
+    import message_store
+
+    now = datetime.now(timezone.utc).isoformat()
+    message_store.LogStore(os.path.join(workdir, "messages.ndjson")).append(
+        [
+            {"content": f"Message {n}", "sender": "Bench", "timestamp": now}
+            for n in range(count)
+        ]
+    )
+
+
+def parse_importtime(output: str, name: str) -> tuple:
+    """Extract the imports of an app from the output of python -X importtime.
+
+    Args:
+        output (str): stderr of the child process
+        name (str): the app module
+
+    Returns:
+        tuple: the direct imports of the app module and the modules imported
+            after it (lists of (module, cumulative ms)), heaviest first
+
+    """
+    direct, later, pending, imported = [], [], [], False
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # the header
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        entry = (module.strip(), round(int(cumulative) / 1000, 1))
+        if depth == 1:  # imported by the module of the next depth 0 line
+            pending.append(entry)
+        elif depth == 0:
+            if entry[0] == name:
+                direct, imported = pending, True
+            elif imported and entry[0] not in BENCHMARK_IMPORTS:
+                later.append(entry)
+            pending = []
+    return (
+        sorted(direct, key=lambda e: -e[1])[:TOP_IMPORTS],
+        sorted(later, key=lambda e: -e[1])[:TOP_IMPORTS],
+    )
+
+
+def measure(name: str, warm_up: bool, args) -> tuple:
+    """Start an app in a fresh interpreter and time it.
+
+    Args:
+        name (str): "hub", "channel" or "client"
+        warm_up (bool): call the app's warm_up before the first request
+        args (argparse.Namespace): command line arguments
+
+    Returns:
+        tuple: seconds of every phase and the output of -X importtime
+
+    """
+    options = {"channels": args.channels}
+    with tempfile.TemporaryDirectory() as workdir:
+        if name == "channel":
+            preload_messages(workdir, args.history)
+        child = [sys.executable, "-X", "importtime", os.path.abspath(__file__)]
+        child += ["--run", name, "--workdir", workdir, "--options", json.dumps(options)]
+        if warm_up:
+            child.append("--warm-up")
+        result = subprocess.run(child, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"{name} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def summarize(runs: list) -> dict:
+    """Return the median milliseconds of every phase.
+
+    Args:
+        runs (list): seconds of every phase, one dict per run
+
+    Returns:
+        dict: phase -> median ms, and the time to the first response
+
+    """
+    result = {}
+    for phase in PHASES:
+        values = [run[phase] for run in runs if phase in run]
+        if values:
+            result[f"{phase}_ms"] = round(statistics.median(values) * 1000, 1)
+    result["time_to_first_response_ms"] = round(
+        statistics.median([sum(run.get(p, 0) for p in PHASES[:3]) for run in runs])
+        * 1000,
+        1,
+    )
+    return result
+
+
+def git_commit() -> str:
+    """Return the commit of the working tree.
+
+    Returns:
+        str: the commit hash, None outside of a git repository
+
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: dict, baseline=None) -> None:
+    """Print the results, with the change relative to a baseline if given.
+
+    Args:
+        report (dict): results of this run
+        baseline (dict): results of an earlier run
+
+    """
+
+    def change(name, mode, key, value):
+        old = (baseline or {}).get("apps", {}).get(name, {}).get(mode, {}).get(key)
+        if not old or value is None:
+            return ""
+        return f" ({(value - old) / old:+.0%})"
+
+    keys = [f"{phase}_ms" for phase in PHASES] + ["time_to_first_response_ms"]
+    print(f"Startup, median of {report['settings']['runs']} runs (ms):")
+    print(f"{'app':<8} {'mode':<9}" + "".join(f"{k[:-3]:>24}" for k in keys))
+    for name, result in report["apps"].items():
+        for mode in ("warm_up", "cold"):
+            cells = []
+            for key in keys:
+                value = result[mode].get(key)
+                text = "-" if value is None else f"{value}"
+                cells.append(f"{text + change(name, mode, key, value):>24}")
+            print(f"{name:<8} {mode:<9}" + "".join(cells))
+    for name, result in report["apps"].items():
+        print(f"\n{name}: heaviest imports (cumulative ms)")
+        print("  " + ", ".join(f"{m} {ms}" for m, ms in result["imports"]))
+        if result["later_imports"]:
+            print("  imported by warm_up or the first request:")
+            print("  " + ", ".join(f"{m} {ms}" for m, ms in result["later_imports"]))
+
+
+def main():
+    """Run the benchmark, print the report and save it."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="runs per app and mode")
+    parser.add_argument("--apps", default=",".join(APPS), help="apps to measure")
+    parser.add_argument("--history", type=int, default=1000, help="channel messages")
+    parser.add_argument("--channels", type=int, default=100, help="channels at the hub")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    parser.add_argument("--run", choices=APPS, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--warm-up", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--options", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        seconds = run(args.run, args.workdir, args.warm_up, json.loads(args.options))
+        print(json.dumps(seconds))
+        return
+
+    apps = {}
+    for name in args.apps.split(","):
+        runs = {"warm_up": [], "cold": []}
+        for _ in range(args.runs):
+            for mode in runs:
+                seconds, output = measure(name, mode == "warm_up", args)
+                runs[mode].append(seconds)
+                if mode == "warm_up":
+                    importtime = output
+        imports, later_imports = parse_importtime(importtime, name)
+        apps[name] = {
+            "warm_up": summarize(runs["warm_up"]),
+            "cold": summarize(runs["cold"]),
+            "imports": imports,
+            "later_imports": later_imports,
+        }
+    report = {
+        "commit": git_commit(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "run", "workdir", "warm_up", "options")
+        },
+        "apps": apps,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""store_stress.py - post messages from many processes and threads, check none are lost.
+
+Every worker process runs the channel app with a shared temporary message
+store and posts messages from several threads through the Flask test client.
+Afterwards all messages must be in the store exactly once, with unique ids.
+With --preload the store is opened (and its lock taken) before the workers
+are forked, as in a preloading WSGI server.
+
+Run from the repository root:
+
+    > python benchmarks/store_stress.py --store log
+    > python benchmarks/store_stress.py --store json
+    > python benchmarks/store_stress.py --store sqlite
+    > python benchmarks/store_stress.py --store log --preload
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import channel  # noqa: E402
+
+
+def configure(store: str, directory: str) -> None:
+    """Point the channel app at a fresh store in a temporary directory.
+
+    Args:
+        store (str): "log", "json" or "sqlite"
+        directory (str): directory of the store files
+
+    """
+    channel.CHANNEL_STORE = store
+    channel.CHANNEL_FILE = os.path.join(directory, "messages.json")
+    channel.CHANNEL_LOG_FILE = os.path.join(directory, "messages.ndjson")
+    channel.CHANNEL_DB_FILE = os.path.join(directory, "messages.sqlite3")
+    channel.STORE = None
+
+
+def post_messages(process: int, threads: int, messages: int) -> None:
+    """Post messages from several threads of this process.
+
+    Args:
+        process (int): number of the process, part of the sender name
+        threads (int): number of threads
+        messages (int): messages per thread
+
+    """
+    client = channel.app.test_client()
+    headers = {"Authorization": "authkey " + channel.CHANNEL_AUTHKEY}
+    errors = []
+
+    def run(thread):
+        for i in range(messages):
+            response = client.post(
+                "/",
+                json={
+                    "content": f"message {i}",
+                    "sender": f"p{process}t{thread}",
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                },
+                headers=headers,
+            )
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    workers = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        sys.exit(f"process {process}: {len(errors)} failed requests")
+
+
+def main():
+    """Run the stress test and exit with an error if messages were lost."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", choices=("log", "json", "sqlite"), default="log")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=50, help="per thread")
+    parser.add_argument(
+        "--preload", action="store_true", help="open the store before forking"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure(args.store, directory)
+        if args.preload:
+            channel.get_store().replace([])
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=post_messages, args=(p, args.threads, args.messages))
+            for p in range(args.processes)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        channel.STORE = None
+        stored = channel.get_store().read()
+        expected = args.processes * args.threads * args.messages
+        ids = [m["id"] for m in stored]
+        keys = {(m["sender"], m["content"]) for m in stored}
+        print(
+            f"{args.store}: {len(stored)}/{expected} messages in {elapsed:.2f} s "
+            f"({expected / elapsed:.0f} messages/s)"
+        )
+        if any(worker.exitcode for worker in workers):
+            sys.exit("a worker process failed")
+        if len(stored) != expected or len(keys) != expected:
+            sys.exit("messages were lost or duplicated")
+        if len(set(ids)) != len(ids) or ids != sorted(ids):
+            sys.exit("message ids are not unique and ascending")
+        print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""broadcast.py - in-process fan-out of store updates to waiting subscribers."""
+
+import threading
+
+
+class Broadcaster(object):
+    """Wake up all threads waiting for a change of the message store.
+
+    Every published change increments ``version``. Subscribers remember the
+    version they have seen and block in ``wait`` until it changes.
+    """
+
+    def __init__(self):
+        """Create a broadcaster without any published change."""
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def publish(self) -> None:
+        """Announce a change and wake up all waiting subscribers."""
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Block until a change newer than ``version`` was published.
+
+        Args:
+            version (int): the last version seen by the subscriber
+            timeout (float): maximum seconds to wait
+
+        Returns:
+            int: the current version (equal to ``version`` on timeout)
+
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
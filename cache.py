@@ -0,0 +1,253 @@
+"""cache.py - bounded in-memory caches with expiry or version validation."""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Least recently used cache whose entries expire after ``ttl`` seconds.
+
+    If a ``path`` is given, the entries are loaded from that JSON file on
+    creation and written back (atomically) at most every ``save_interval``
+    seconds after entries were added, and at exit, so the cache survives
+    restarts of the process. Entries other processes saved in the file are
+    kept. Keys must be strings and values JSON serializable in that case;
+    tuples come back as lists.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float, path=None, clock=time.time, save_interval=60
+    ):
+        """Create a cache.
+
+        Args:
+            maxsize (int): maximum number of entries
+            ttl (float): seconds until an entry expires
+            path (str): optional JSON file to persist the entries in
+            clock (callable): returns the current (wall clock) time in seconds
+            save_interval (float): minimum seconds between writes of the file
+
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.save_interval = save_interval
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False  # entries were added since the last save
+        self.saved_at = clock()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # serializes writes of the file
+        if path:
+            self.load()
+            atexit.register(self.flush)
+
+    def get(self, key):
+        """Return the cached value of a key.
+
+        Args:
+            key (str): the key
+
+        Returns:
+            Any: the value, None if it isn't cached or expired
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        """Cache a value, evicting the least recently used entries if full.
+
+        Args:
+            key (str): the key
+            value (Any): the value, must not be None
+
+        """
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            self.dirty = True
+        if self.path and self.clock() - self.saved_at >= self.save_interval:
+            self.flush()
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Return the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: entries, hits, misses and hit rate
+
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+    def load(self) -> None:
+        """Load the non-expired entries from the cache file."""
+        for key, expires, value in self.read_file()[-self.maxsize :]:
+            self.entries[key] = (expires, value)
+
+    def read_file(self) -> list:
+        """Return the non-expired entries of the cache file.
+
+        Returns:
+            list: [key, expiry time, value] lists, least recently used first
+
+        """
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+        now = self.clock()
+        return [entry for entry in entries if entry[1] > now]
+
+    def flush(self) -> None:
+        """Write the entries to the cache file if entries were added since."""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = list(self.entries.items())
+                self.dirty = False
+                self.saved_at = self.clock()
+            self.save(entries)
+
+    def save(self, entries: list) -> None:
+        """Write entries to the cache file, keeping the ones saved by others.
+
+        Args:
+            entries (list): (key, (expiry time, value)) pairs, least recently
+                used first
+
+        """
+        merged = OrderedDict((k, (e, v)) for k, e, v in self.read_file())
+        for key, entry in entries:
+            merged.pop(key, None)
+            merged[key] = entry
+        rows = [[k, e, v] for k, (e, v) in merged.items()][-self.maxsize :]
+        tmp_path = "{}.{}.{}.tmp".format(self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(rows, f)
+        os.replace(tmp_path, self.path)
+
+
+class VersionedCache(object):
+    """Least recently used cache whose entries belong to a version of their source.
+
+    An entry is only returned for the version it was created for (e.g. a
+    token derived from the modification of a file), so a change of the source
+    invalidates it, even if the change was made by another process. Entries
+    may also carry a time after which they are no longer valid.
+    """
+
+    def __init__(self, maxsize: int, clock=time.time):
+        """Create a cache.
+
+        Args:
+            maxsize (int): maximum number of entries
+            clock (callable): returns the current (wall clock) time in seconds
+
+        """
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (version, expiry time, value)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return the cached value of a key for a version.
+
+        Args:
+            key (Hashable): the key
+            version (Hashable): the current version of the source
+
+        Returns:
+            Any: the value, None if it isn't cached for this version or expired
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                entry is None
+                or entry[0] != version
+                or (entry[1] is not None and entry[1] <= self.clock())
+            ):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, version, value, expires=None) -> None:
+        """Cache a value, evicting the least recently used entries if full.
+
+        Args:
+            key (Hashable): the key
+            version (Hashable): the version of the source the value was built from
+            value (Any): the value, must not be None
+            expires (float): time after which the value is invalid, None for never
+
+        """
+        with self.lock:
+            self.entries[key] = (version, expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self, match=None) -> None:
+        """Remove all entries, or the entries of some keys.
+
+        Args:
+            match (callable): called with a key, returns whether to remove its
+                entry; None removes all entries
+
+        """
+        with self.lock:
+            if match is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        """Return the size and the hit/miss counters of the cache.
+
+        Returns:
+            dict: entries, hits, misses and hit rate
+
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
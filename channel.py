@@ -1,13 +1,42 @@
 """channel.py - a simple message channel."""
 
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify
+from flask import abort, g, has_request_context
 from flask_cors import CORS
+import click
 import json
+import os
+import re
 import requests
-from datetime import datetime, timedelta, timezone
-from better_profanity import profanity
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from typing import Tuple
 
+try:  # imported as hub_channel.channel (channel.wsgi)
+    from . import compression
+    from . import http_client
+    from . import metrics
+    from . import profiler
+    from . import serialization
+    from .broadcast import Broadcaster
+    from .cache import TTLCache, VersionedCache
+    from .commands import CommandQueue
+    from . import message_store
+    from .message_store import JsonFileStore, LogStore, SQLiteStore
+except ImportError:  # run as script or via flask --app channel.py
+    import compression
+    import http_client
+    import metrics
+    import profiler
+    import serialization
+    from broadcast import Broadcaster
+    from cache import TTLCache, VersionedCache
+    from commands import CommandQueue
+    import message_store
+    from message_store import JsonFileStore, LogStore, SQLiteStore
+
 
 # Class-based application configuration
 class ConfigClass(object):
@@ -19,7 +48,7 @@ class ConfigClass(object):
 
 # Create Flask app
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag", "X-Last-Id"])
 app.config.from_object(__name__ + ".ConfigClass")  # Configuration
 app.app_context().push()  # Create an app context before initializing the app
 
@@ -31,41 +60,291 @@ CHANNEL_ENDPOINT = "http://vm322.rz.uni-osnabrueck.de/u058/hub_channel/channel.w
 CHANNEL_FILE = "hub_channel/messages.json"
 CHANNEL_TYPE_OF_SERVICE = "aiweb24:chat"
 CHANNEL_MAX_MESSAGE_AGE = 1
+# "log": append-only message log (CHANNEL_LOG_FILE), migrated from CHANNEL_FILE
+# "sqlite": SQLite database (CHANNEL_DB_FILE), migrated from CHANNEL_FILE
+# "json": legacy single JSON file (CHANNEL_FILE), rewritten on every message
+CHANNEL_STORE = "log"
+CHANNEL_LOG_FILE = "hub_channel/messages.ndjson"
+CHANNEL_DB_FILE = "hub_channel/messages.sqlite3"
+CHANNEL_COMPACT_INTERVAL = 3600  # seconds between compactions of the log
+CHANNEL_EXPIRE_INTERVAL = 60  # seconds between removals of expired messages
+CHANNEL_FSYNC = False  # fsync every write of the log (slower, survives power loss)
+CHANNEL_MAX_WAIT = 25  # max seconds a long-poll (GET /?since=..&wait=..) is held
+CHANNEL_STREAM_TIMEOUT = 300  # seconds until a /stream is closed (clients reconnect)
+CHANNEL_MAX_STREAMS = 4  # open /streams per process, each holds a worker thread
+CHANNEL_KEEPALIVE_INTERVAL = 15  # seconds between keep-alive comments on /stream
+CHANNEL_POLL_INTERVAL = 1  # seconds between checks for messages of other processes
+CHANNEL_READ_CACHE_SIZE = 256  # encoded GET / responses cached (per since and limit)
+CHANNEL_MAX_BATCH = 10000  # messages per batch POST (NDJSON: per store write)
+
+GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+WEATHER_URL = "https://api.open-meteo.com/v1/forecast"
+GEOCODING_CACHE_SIZE = 10000  # cached locations (including unknown ones)
+GEOCODING_CACHE_TTL = 7 * 24 * 3600  # seconds a location is cached
+WEATHER_CACHE_SIZE = 1000  # cached weather reports
+WEATHER_CACHE_TTL = 600  # seconds a weather report is cached
+WEATHER_PRECISION = 2  # decimals of latitude/longitude of a weather report
+CHANNEL_ASYNC_COMMANDS = True  # handle commands in the background
+CHANNEL_COMMAND_WORKERS = 4  # threads handling commands
+CHANNEL_MAX_PENDING_COMMANDS = 64  # queued commands before new ones are refused
+CHANNEL_COMMAND_TIMEOUT = 15  # seconds until a command is answered with an error
+CHANNEL_CACHE_DIR = None  # directory to persist the caches in, None: memory only
+CHANNEL_CACHE_SAVE_INTERVAL = 60  # min seconds between writes of a persisted cache
+CHANNEL_PROFILE_SAMPLE_RATE = 0  # profile 1 in N POST requests, 0: only on request
+CHANNELS_FILE = None  # JSON list of channels served under /<id>/ too, None: only /
+CHANNELS_DIR = "hub_channel/channels"  # message stores of those, one directory each
+CHANNELS_REGISTER_WORKERS = 8  # concurrent registrations of register_channels
+CHANNEL_PROFILE_FILE = None  # file to dump the POST profile to (+ .pid), None: none
+
+STORE = None
+CHANNELS = None
+READ_CACHE = VersionedCache(CHANNEL_READ_CACHE_SIZE)
+STREAM_SLOTS = threading.BoundedSemaphore(CHANNEL_MAX_STREAMS)
+PROFILER = profiler.SamplingProfiler(CHANNEL_PROFILE_SAMPLE_RATE, CHANNEL_PROFILE_FILE)
+PROFANITY_FILTER = None
+GEOCODING_CACHE = TTLCache(
+    GEOCODING_CACHE_SIZE,
+    GEOCODING_CACHE_TTL,
+    path=CHANNEL_CACHE_DIR and os.path.join(CHANNEL_CACHE_DIR, "geocoding_cache.json"),
+    save_interval=CHANNEL_CACHE_SAVE_INTERVAL,
+)
+WEATHER_CACHE = TTLCache(
+    WEATHER_CACHE_SIZE,
+    WEATHER_CACHE_TTL,
+    path=CHANNEL_CACHE_DIR and os.path.join(CHANNEL_CACHE_DIR, "weather_cache.json"),
+    save_interval=CHANNEL_CACHE_SAVE_INTERVAL,
+)
+STORE_SECONDS = metrics.Histogram(
+    "channel_store_duration_seconds",
+    "Duration of message store operations.",
+    ("store", "operation"),
+)
+CENSOR_SECONDS = metrics.Histogram(
+    "channel_censor_duration_seconds", "Duration of censoring a posted message."
+)
+metrics.REGISTRY.add_collector(
+    metrics.cache_collector(
+        {
+            "geocoding": GEOCODING_CACHE,
+            "weather": WEATHER_CACHE,
+            "responses": READ_CACHE,
+        }
+    )
+)
 
 
-@app.cli.command("register")
-def register_command():
-    """Register the channel with the hub by sending a POST request.
+class Channel(object):
+    """A channel served by this process.
 
-    This function sends the channel information to the hub server to
-    register it and create a new channel.
+    The default channel (DEFAULT_CHANNEL, served at /) is configured by the
+    CHANNEL_* settings. The channels listed in CHANNELS_FILE are served under
+    /<id>/ as well, each with its own name, endpoint, authkey and message
+    store (of type CHANNEL_STORE in CHANNELS_DIR/<id>). The profanity filter,
+    lookup and response caches, command workers and HTTP pools are shared, so
+    an additional channel costs little more than its messages.
+    """
+
+    def __init__(self, id=None, settings=None):
+        """Create a channel.
+
+        Args:
+            id (str): path prefix of the channel, None for the default channel
+            settings (dict): name, authkey and optionally endpoint (by default
+                CHANNEL_ENDPOINT/<id>); the default channel uses the CHANNEL_*
+                settings
+
+        """
+        self.id = id
+        self.settings = settings or {}
+        self.store = None
+        self.broadcaster = Broadcaster()
+
+    @property
+    def name(self) -> str:
+        """str: name of the channel."""
+        return self.settings.get("name", CHANNEL_NAME)
+
+    @property
+    def authkey(self) -> str:
+        """str: authkey of the channel."""
+        return self.settings.get("authkey", CHANNEL_AUTHKEY)
+
+    @property
+    def endpoint(self) -> str:
+        """str: URL of the channel."""
+        if self.id is None:
+            return CHANNEL_ENDPOINT
+        return self.settings.get(
+            "endpoint", CHANNEL_ENDPOINT.rstrip("/") + "/" + self.id
+        )
+
+    def get_store(self):
+        """Return the message store of the channel, created on first use.
+
+        Returns:
+            MessageStore: the message store
+
+        """
+        if self.id is None:
+            return get_store()
+        if self.store is None:
+            directory = os.path.join(CHANNELS_DIR, self.id)
+            os.makedirs(directory, exist_ok=True)
+            self.store = create_store(
+                os.path.join(directory, "messages.json"),
+                os.path.join(directory, "messages.ndjson"),
+                os.path.join(directory, "messages.sqlite3"),
+            )
+        return self.store
+
+
+DEFAULT_CHANNEL = Channel()
+
+
+def get_channels() -> dict:
+    """Return the channels listed in CHANNELS_FILE, read on first use.
+
+    The file contains a JSON list of objects with the id, name and authkey
+    (and optionally the endpoint) of every channel. Ids must be unique, made
+    of letters, digits, "-" and "_" and differ from the top-level paths of
+    the app (e.g. "stats").
+
+    Raises:
+        ValueError: if a channel is invalid
 
     Returns:
-        None
+        dict: ids mapped to Channel objects, empty without CHANNELS_FILE
+
+    """
+    global CHANNELS
+    if CHANNELS is None:
+        channels = {}
+        if CHANNELS_FILE:
+            with open(CHANNELS_FILE, encoding="utf-8") as f:
+                entries = json.load(f)
+            reserved = {
+                rule.rule.strip("/").split("/")[0] for rule in app.url_map.iter_rules()
+            }
+            for entry in entries:
+                id = entry.get("id", "")
+                if not re.fullmatch(r"[A-Za-z0-9_-]+", id) or id in reserved:
+                    raise ValueError(f"Invalid channel id {id!r}")
+                if id in channels:
+                    raise ValueError(f"Duplicate channel id {id!r}")
+                if not entry.get("name") or not entry.get("authkey"):
+                    raise ValueError(f"Channel {id!r} has no name or authkey")
+                channels[id] = Channel(id, entry)
+        CHANNELS = channels
+    return CHANNELS
+
+
+def served_channels() -> list:
+    """Return all channels served by this process.
+
+    Returns:
+        list: the default channel followed by the channels of CHANNELS_FILE
+
+    """
+    return [DEFAULT_CHANNEL] + list(get_channels().values())
+
+
+def current_channel() -> Channel:
+    """Return the channel addressed by the current request.
+
+    Returns:
+        Channel: the channel of the /<id>/ prefix, DEFAULT_CHANNEL otherwise
+
+    """
+    if not has_request_context():
+        return DEFAULT_CHANNEL
+    return g.get("channel", DEFAULT_CHANNEL)
+
+
+@app.url_value_preprocessor
+def select_channel(endpoint, values):
+    """Look up the channel of the /<id>/ prefix of a request.
+
+    Args:
+        endpoint (str): endpoint of the request
+        values (dict): URL values, the channel_id is removed from them
 
     """
-    global CHANNEL_AUTHKEY, CHANNEL_NAME, CHANNEL_ENDPOINT
+    id = values.pop("channel_id", None) if values else None
+    if id is None:
+        g.channel = DEFAULT_CHANNEL
+        return
+    g.channel = get_channels().get(id)
+    if g.channel is None:
+        abort(404, "Unknown channel")
+
+
+def register_channel(channel: Channel):
+    """Register (or update) a channel with the hub.
+
+    Args:
+        channel (Channel): the channel
+
+    Returns:
+        requests.Response: the response of the hub
 
+    """
     # Send a POST request to server /channels
-    response = requests.post(
+    return http_client.post(
         HUB_URL + "/channels",
         headers={"Authorization": "authkey " + HUB_AUTHKEY},
         data=json.dumps(
             {
-                "name": CHANNEL_NAME,
-                "endpoint": CHANNEL_ENDPOINT,
-                "authkey": CHANNEL_AUTHKEY,
+                "name": channel.name,
+                "endpoint": channel.endpoint,
+                "authkey": channel.authkey,
                 "type_of_service": CHANNEL_TYPE_OF_SERVICE,
             }
         ),
     )
 
+
+@app.cli.command("register")
+def register_command():
+    """Register the channel with the hub by sending a POST request.
+
+    This function sends the channel information to the hub server to
+    register it and create a new channel.
+
+    Returns:
+        None
+
+    """
+    response = register_channel(DEFAULT_CHANNEL)
+
     if response.status_code != 200:
         print("Error creating channel: " + str(response.status_code))
         print(response.text)
         return
 
 
+@app.cli.command("register_channels")
+def register_channels_command():
+    """Register all channels of this process (see CHANNELS_FILE) with the hub.
+
+    Up to CHANNELS_REGISTER_WORKERS registrations run concurrently, since the
+    hub checks the health of every channel before answering.
+    """
+
+    def register(channel):
+        try:
+            response = register_channel(channel)
+        except Exception as e:
+            return f"error: {e}"
+        if response.status_code != 200:
+            return f"error {response.status_code}: {response.text}"
+        return "OK"
+
+    channels = served_channels()
+    with ThreadPoolExecutor(max_workers=CHANNELS_REGISTER_WORKERS) as executor:
+        for channel, result in zip(channels, executor.map(register, channels)):
+            print(f"{channel.endpoint}: {result}")
+
+
 def check_authorization(request):
     """Check if the authorization header is valid.
 
@@ -76,17 +355,33 @@ def check_authorization(request):
         bool: True if authorization is valid, False otherwise.
 
     """
-    global CHANNEL_AUTHKEY
     # Check if Authorization header is present
     if "Authorization" not in request.headers:
         return False
     # Check if the authorization header is valid
-    if request.headers["Authorization"] != "authkey " + CHANNEL_AUTHKEY:
+    if request.headers["Authorization"] != "authkey " + current_channel().authkey:
         return False
     return True
 
 
+def profile_requested() -> bool:
+    """Check if the request asks to be profiled.
+
+    A request is profiled (regardless of CHANNEL_PROFILE_SAMPLE_RATE) if it
+    has an ``X-Profile: authkey <authkey of the channel>`` header.
+
+    Returns:
+        bool: True if the request must be profiled
+
+    """
+    return request.headers.get("X-Profile") == "authkey " + current_channel().authkey
+
+
+metrics.instrument(app, "channel", authorize=check_authorization)
+
+
 @app.route("/health", methods=["GET"])
+@app.route("/<channel_id>/health", methods=["GET"])
 def health_check():
     """Check the health status of the channel.
 
@@ -95,18 +390,91 @@ def health_check():
                or an error message if unauthorized.
 
     """
-    global CHANNEL_NAME
     if not check_authorization(request):
         return "Invalid authorization", 400
-    return jsonify({"name": CHANNEL_NAME}), 200
+    return jsonify({"name": current_channel().name}), 200
+
+
+@app.route("/stats/http", methods=["GET"])
+def http_stats():
+    """Return statistics of the outbound HTTP connection pools.
+
+    Returns:
+        JSON: request counters, circuit states and connection reuse per host
+               if authorized, or an error message if unauthorized.
+
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(http_client.stats()), 200
+
+
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    """Return size and hit/miss counters of the lookup caches.
+
+    Returns:
+        JSON: statistics per cache if authorized,
+               or an error message if unauthorized.
+
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(
+        geocoding=GEOCODING_CACHE.stats(),
+        weather=WEATHER_CACHE.stats(),
+        responses=READ_CACHE.stats(),
+    ), 200
+
+
+@app.route("/stats/profile", methods=["GET", "DELETE"])
+def profile_stats():
+    """Return the hot spots of the profiled POST requests of this process.
+
+    POST requests are profiled if they are sampled (1 in
+    CHANNEL_PROFILE_SAMPLE_RATE) or carry an X-Profile header, see
+    profile_requested. ``?limit=<n>`` and ``?sort=<key>`` (a pstats sort key
+    like cumulative, tottime or calls) select the reported functions, DELETE
+    forgets the collected profiles. Commands are only part of the profile if
+    they are handled in the request (CHANNEL_ASYNC_COMMANDS = False).
+
+    Returns:
+        JSON: counters and the top functions if authorized,
+               or an error message if unauthorized.
+
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    if request.method == "DELETE":
+        PROFILER.reset()
+        return "OK", 200
+    try:
+        limit = int(request.args.get("limit", 30))
+        return jsonify(PROFILER.report(limit, request.args.get("sort", "cumulative")))
+    except (KeyError, ValueError):
+        return "Invalid limit or sort", 400
 
 
 # GET: Return list of messages
 @app.route("/", methods=["GET"])
+@app.route("/<channel_id>/", methods=["GET"], strict_slashes=False)
 def home_page():
     """Return a list of messages in JSON format.
 
-    This function handles GET requests to fetch all messages.
+    This function handles GET requests to fetch all messages. With
+    ``?since=<id>`` only messages newer than the given message id are
+    returned, ``?limit=<n>`` caps the number of returned messages. Adding
+    ``&wait=<seconds>`` turns the request into a long-poll, which is answered
+    as soon as a new message arrives. The response carries an ETag, so an
+    unchanged list costs a 304.
+
+    Encoded responses are kept in READ_CACHE until the store's version
+    changes (also by writes of other processes) or one of their messages
+    expires, so repeated reads of an unchanged channel don't touch the store.
+    Responses are compressed (gzip or brotli, see compression) if the client
+    accepts it, each cached response at most once per encoding. Clients
+    preferring ``application/msgpack`` get MessagePack (if msgpack is
+    installed, see serialization).
 
     Returns:
         JSON: A JSON response containing the list of messages if authorized,
@@ -115,13 +483,193 @@ def home_page():
     """
     if not check_authorization(request):
         return "Invalid authorization", 400
-    # Fetch channels from server
-    return jsonify(read_messages())
+    since = request.args.get("since", None, type=int)
+    limit = request.args.get("limit", None, type=int)
+    wait = request.args.get("wait", 0, type=float)
+    mimetype = serialization.choose_format(request)
+    channel = current_channel()
+    store = channel.get_store()
+    if since is not None and since > store.last_id():
+        since = None  # cursor from before a reset of the store, send everything
+    if since is not None and wait > 0:
+        messages = wait_for_messages(
+            since, min(wait, CHANNEL_MAX_WAIT), limit, channel=channel
+        )
+        etag, body, last_id = encode_messages(store, messages, mimetype)
+    else:
+        etag, body, last_id = read_encoded_messages(channel, since, limit, mimetype)
+    response = compression.make_response(app, request, body, etag, mimetype)
+    response.vary.add("Accept")
+    response.headers["X-Last-Id"] = str(last_id)
+    return response
+
+
+def read_encoded_messages(
+    channel: Channel, since=None, limit=None, mimetype=serialization.JSON
+) -> tuple:
+    """Return the encoded messages selected by a GET / request.
+
+    Args:
+        channel (Channel): the channel
+        since (int): only messages with an id greater than this
+        limit (int): maximum number of messages
+        mimetype (str): the format, serialization.JSON or MSGPACK
+
+    Returns:
+        tuple: ETag, encoded messages (compression.Body) and the newest id,
+            from READ_CACHE if the store didn't change since they were
+            encoded
+
+    """
+    store = channel.get_store()
+    key = (channel.id, since, limit, mimetype)
+    version = store.version()  # before reading: a concurrent write misses
+    if version is not None:
+        cached = READ_CACHE.get(key, version)
+        if cached is not None:
+            return cached
+    with STORE_SECONDS.time(CHANNEL_STORE, "select"):
+        messages = store.select(since, limit)
+    encoded = encode_messages(store, messages, mimetype)
+    if version is not None:
+        READ_CACHE.set(key, version, encoded, expires=store.expires(messages))
+    return encoded
+
+
+def encode_messages(store, messages: list, mimetype=serialization.JSON) -> tuple:
+    """Encode messages for a GET / response.
+
+    Args:
+        store (MessageStore): the message store
+        messages (list): the selected messages
+        mimetype (str): the format, serialization.JSON or MSGPACK
+
+    Returns:
+        tuple: ETag, encoded messages (compression.Body) and the newest id
+
+    """
+    last_id = store.last_id()
+    etag = "{}-{}-{}-{}".format(
+        last_id,
+        len(messages),
+        messages[0].get("id", 0) if messages else 0,
+        messages[-1].get("id", 0) if messages else 0,
+    )
+    if mimetype == serialization.MSGPACK:
+        etag += "-msgpack"
+    body = compression.Body(serialization.encode(messages, mimetype))
+    return etag, body, last_id
+
+
+def messages_changed(channel: Channel = DEFAULT_CHANNEL) -> None:
+    """Invalidate the cached responses and wake up waiting subscribers.
+
+    Args:
+        channel (Channel): the channel whose messages changed
+
+    """
+    READ_CACHE.clear(lambda key: key[0] == channel.id)
+    channel.broadcaster.publish()
+
+
+@app.route("/stream", methods=["GET"])
+@app.route("/<channel_id>/stream", methods=["GET"])
+def stream_messages():
+    """Push new messages to the client as Server-Sent Events.
+
+    Since EventSource can't set headers, the authkey may also be passed as
+    ``?authkey=`` parameter. The stream starts after ``?since=<id>`` or the
+    Last-Event-ID header (sent by reconnecting clients), otherwise with the
+    next new message. It is closed after CHANNEL_STREAM_TIMEOUT seconds.
+
+    Every open stream holds a worker thread, so at most CHANNEL_MAX_STREAMS
+    are open at once; further ones are answered with 503, and clients fall
+    back to long-polls (GET /?since=..&wait=..), which release their thread
+    after at most CHANNEL_MAX_WAIT seconds.
+
+    Returns:
+        Response: an event stream, or an error message if unauthorized or
+            too many streams are open.
+
+    """
+    channel = current_channel()
+    if (
+        not check_authorization(request)
+        and request.args.get("authkey") != channel.authkey
+    ):
+        return "Invalid authorization", 400
+    since = request.args.get("since", None, type=int)
+    if since is None:
+        since = request.headers.get("Last-Event-ID", None, type=int)
+    if since is None or since > channel.get_store().last_id():
+        since = channel.get_store().last_id()
+    if not STREAM_SLOTS.acquire(blocking=False):
+        return "Too many open streams, use long-polling", 503, {"Retry-After": "60"}
+
+    def generate(cursor):
+        deadline = time.monotonic() + CHANNEL_STREAM_TIMEOUT
+        yield "retry: 3000\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            messages = wait_for_messages(
+                cursor, min(remaining, CHANNEL_KEEPALIVE_INTERVAL), channel=channel
+            )
+            if not messages:
+                yield ": keep-alive\n\n"
+                continue
+            for message in messages:
+                data = serialization.dumps(message).decode()
+                yield "id: {}\ndata: {}\n\n".format(message["id"], data)
+            cursor = messages[-1]["id"]
+
+    response = Response(
+        generate(since),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(STREAM_SLOTS.release)
+    return response
+
+
+def wait_for_messages(
+    since: int, timeout: float, limit=None, channel: Channel = DEFAULT_CHANNEL
+) -> list:
+    """Wait until there are messages newer than ``since``.
+
+    Subscribers are woken up by the broadcaster of the channel when this
+    process stores a message; messages stored by other processes are picked
+    up every CHANNEL_POLL_INTERVAL seconds.
+
+    Args:
+        since (int): id of the last message the caller has seen
+        timeout (float): maximum seconds to wait
+        limit (int): maximum number of messages to return
+        channel (Channel): the channel
+
+    Returns:
+        list: the new messages, empty if none arrived in time
+
+    """
+    store = channel.get_store()
+    broadcaster = channel.broadcaster
+    deadline = time.monotonic() + timeout
+    while True:
+        version = broadcaster.version
+        with STORE_SECONDS.time(CHANNEL_STORE, "select"):
+            messages = store.select(since, limit)
+        remaining = deadline - time.monotonic()
+        if messages or remaining <= 0:
+            return messages
+        broadcaster.wait(version, min(remaining, CHANNEL_POLL_INTERVAL))
 
 
 def get_coordinates(location: str) -> Tuple[str, str]:
     """Calculate the latitude and longitude of a location using the Open Meteo API.
 
+    Results, including unknown locations, are cached in GEOCODING_CACHE.
+
     Args:
         location (str): location of interest
 
@@ -132,21 +680,28 @@ def get_coordinates(location: str) -> Tuple[str, str]:
         Tuple[str, str]: latitude, longitude
 
     """
-    url = "https://geocoding-api.open-meteo.com/v1/search"
+    key = location.strip().lower()
+    cached = GEOCODING_CACHE.get(key)
+    if cached is not None:
+        return tuple(cached)
+
+    url = GEOCODING_URL
 
     # parameters for the API request
     params = {"name": location, "count": 1, "language": "en", "format": "json"}
 
     try:
-        response = requests.get(url, params=params)
+        response = http_client.get(url, params=params)
         response.raise_for_status()
 
         location_data = response.json().get("results", None)
         if not location_data:
+            GEOCODING_CACHE.set(key, (None, None))
             return None, None
         latitude = location_data[0].get("latitude", None)
         longitude = location_data[0].get("longitude", None)
 
+        GEOCODING_CACHE.set(key, (latitude, longitude))
         return latitude, longitude
 
     except requests.exceptions.RequestException as e:
@@ -156,6 +711,9 @@ def get_coordinates(location: str) -> Tuple[str, str]:
 def get_weather(latitude: str, longitude: str) -> Tuple[str, str]:
     """Fetch weather info from open meteo API.
 
+    The coordinates are rounded to WEATHER_PRECISION decimals, reports are
+    cached in WEATHER_CACHE.
+
     Args:
         latitude (str): latitude of the point of interest
         longitude (str): longitude of the point of interest
@@ -167,20 +725,29 @@ def get_weather(latitude: str, longitude: str) -> Tuple[str, str]:
         Tuple[str, str]: temperature[°C], windspeed[km/h]
 
     """
-    url = "https://api.open-meteo.com/v1/forecast"
+    latitude = round(float(latitude), WEATHER_PRECISION)
+    longitude = round(float(longitude), WEATHER_PRECISION)
+    key = f"{latitude},{longitude}"
+    cached = WEATHER_CACHE.get(key)
+    if cached is not None:
+        return tuple(cached)
+
+    url = WEATHER_URL
 
     # parameters for the API request
     params = {"latitude": latitude, "longitude": longitude, "current_weather": True}
 
     try:
-        response = requests.get(url, params=params)
+        response = http_client.get(url, params=params)
         response.raise_for_status()
 
         weather_data = response.json()
         current_weather = weather_data.get("current_weather", {})
 
         if current_weather:
-            return current_weather["temperature"], current_weather["windspeed"]
+            weather = current_weather["temperature"], current_weather["windspeed"]
+            WEATHER_CACHE.set(key, weather)
+            return weather
         else:
             raise Exception("No weather info received!")
 
@@ -188,83 +755,146 @@ def get_weather(latitude: str, longitude: str) -> Tuple[str, str]:
         raise Exception(f"Error fetching the weather data: {e}")
 
 
-def handle_commands(message, messages: list) -> None:
-    """Handle commands by checking if it begins with !weather ....
+def bot_message(content: str, sender: str = "Weather") -> dict:
+    """Create a reply message of the channel.
 
     Args:
-        message (str): user message
-        messages (list): all messages
+        content (str): text of the reply
+        sender (str): name of the replying bot
+
+    Returns:
+        dict: the message
 
     """
-    content = message["content"].strip()
-    if content == "!weather":
-        # our client didnt get the location
-        if "extra" in message and message["extra"] == "ERROR":
-            messages.append(
-                {
-                    "content": f"Sorry we were not able to get your location. Try to add your location as parameter.",
-                    "sender": "Weather",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "extra": "",
-                    })
+    return {
+        "content": content,
+        "sender": sender,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "extra": "",
+    }
+
+
+def weather_command(message, place: str) -> list:
+    """Reply to "!weather [<location>]" with the current weather.
+
+    Without a location, the coordinates sent by our client are used.
+
+    Args:
+        message (dict): user message
+        place (str): location given after the command, may be empty
+
+    Returns:
+        list: the reply messages
+
+    """
+    if not place:
         # our client got the location
-        elif "latitude" in message and "longitude" in message:
-            temperature, windspeed = get_weather(message["latitude"], message["longitude"])
-            messages.append(
-                {
-                    "content": f"Today it is going to be {temperature}°C with a windspeed of {windspeed}km/h at your place.",
-                    "sender": "Weather",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "extra": "",
-                    })
-        # other client used
-        else:
-            messages.append(
-                {
-                    "content": f"Sorry we were not able to get your location. Try to add your location as parameter.",
-                    "sender": "Weather",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "extra": "",
-                    })
-    elif content.startswith("!weather "):
-        place = profanity.censor(content[9:])
-        latitude, longitude = get_coordinates(place)
-        if not latitude or not longitude:
-            messages.append(
-                {
-                    "content": f"Location '{place}' not found.",
-                    "sender": "Weather",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "extra": "",
-                }
+        if (
+            message.get("extra") != "ERROR"
+            and "latitude" in message
+            and "longitude" in message
+        ):
+            temperature, windspeed = get_weather(
+                message["latitude"], message["longitude"]
             )
-        else:
-            temperature, windspeed = get_weather(latitude, longitude)
-            messages.append(
-                {
-                    "content": f"Today it is going to be {temperature}°C with a windspeed of {windspeed}km/h in {place}.",
-                    "sender": "Weather",
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "extra": "",
-                }
+            return [
+                bot_message(
+                    f"Today it is going to be {temperature}°C with a windspeed of {windspeed}km/h at your place."
+                )
+            ]
+        # our client didnt get the location or other client used
+        return [
+            bot_message(
+                "Sorry we were not able to get your location. Try to add your location as parameter."
             )
-    elif content.startswith("!"):
-        messages.append(
-            {
-                "content": f"Command '{profanity.censor(content)}' not found.",
-                "sender": "Server",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "extra": "",
-            }
+        ]
+    place = get_profanity_filter().censor(place)
+    latitude, longitude = get_coordinates(place)
+    if not latitude or not longitude:
+        return [bot_message(f"Location '{place}' not found.")]
+    temperature, windspeed = get_weather(latitude, longitude)
+    return [
+        bot_message(
+            f"Today it is going to be {temperature}°C with a windspeed of {windspeed}km/h in {place}."
         )
+    ]
+
+
+def unknown_command(message, argument: str) -> list:
+    """Reply to commands without handler.
+
+    Args:
+        message (dict): user message
+        argument (str): text after the command
+
+    Returns:
+        list: the reply messages
+
+    """
+    content = get_profanity_filter().censor(message["content"].strip())
+    return [bot_message(f"Command '{content}' not found.", "Server")]
+
+
+def command_failed(message, reason: str) -> list:
+    """Reply to commands whose handler failed or timed out.
+
+    Args:
+        message (dict): user message
+        reason (str): description of the failure
+
+    Returns:
+        list: the reply messages
+
+    """
+    print(f"Command {message['content']!r} failed: {reason}")
+    content = get_profanity_filter().censor(message["content"].strip())
+    return [bot_message(f"Sorry, '{content}' failed. Try again later.", "Server")]
+
+
+def deliver_replies(replies: list, channel: Channel = DEFAULT_CHANNEL) -> None:
+    """Store the replies of a command and notify subscribers.
+
+    Args:
+        replies (list): the reply messages
+        channel (Channel): the channel of the command
+
+    """
+    if replies:
+        with STORE_SECONDS.time(CHANNEL_STORE, "append"):
+            channel.get_store().append(replies)
+        messages_changed(channel)
+
+
+COMMANDS = CommandQueue(
+    deliver_replies,
+    command_failed,
+    workers=CHANNEL_COMMAND_WORKERS,
+    max_pending=CHANNEL_MAX_PENDING_COMMANDS,
+    timeout=CHANNEL_COMMAND_TIMEOUT,
+    synchronous=not CHANNEL_ASYNC_COMMANDS,
+)
+COMMANDS.register("!weather", weather_command)
+COMMANDS.default = unknown_command
 
 
 # POST: Send a message
 @app.route("/", methods=["POST"])
+@app.route("/<channel_id>/", methods=["POST"], strict_slashes=False)
+@PROFILER.sampled(force=profile_requested)
 def send_message():
     """Receive and store a new message in the channel.
 
-    This function handles POST requests to add a new message.
+    This function handles POST requests to add a new message. Commands
+    (messages starting with !) are handled in the background by COMMANDS,
+    their replies are added to the channel when they are ready.
+
+    Several messages can be posted at once, as a JSON array of up to
+    CHANNEL_MAX_BATCH messages or as NDJSON stream (one message per line,
+    Content-Type application/x-ndjson). All messages of a batch are stored
+    with a single write, and the response lists the result of every message
+    (``status`` "OK" with the ``id`` of the stored message, or "error" with
+    the ``error``). Messages and batches can also be posted as MessagePack
+    (Content-Type application/msgpack, if msgpack is installed).
 
     Returns:
         str: A response indicating success ("OK") or an error message.
@@ -274,75 +904,327 @@ def send_message():
     # Check authorization header
     if not check_authorization(request):
         return "Invalid authorization", 400
+    channel = current_channel()
+    if request.mimetype == "application/x-ndjson":
+        results = store_batch(
+            read_ndjson(request.stream), CHANNEL_MAX_BATCH, channel=channel
+        )
+        return jsonify(results=results), 200
     # Check if message is present
-    message = request.json
+    message = read_body(request)
+    if isinstance(message, list):
+        if len(message) > CHANNEL_MAX_BATCH:
+            return "Too many messages", 413
+        return jsonify(results=store_batch(message, channel=channel)), 200
+    error = check_message(message)
+    if error:
+        return error, 400
+    if message["content"].strip() == "":
+        return "OK", 200
+
+    # Add message to messages
+    commit_batch([({}, message, censor_message(message))], channel)
+    return "OK", 200
+
+
+def read_body(request):
+    """Decode the body of a POST request (JSON or MessagePack).
+
+    Args:
+        request (flask.Request): the request
+
+    Returns:
+        Any: the decoded body (an invalid body or an unsupported Content-Type
+            abort the request like request.json does)
+
+    """
+    if request.mimetype == serialization.MSGPACK:
+        try:
+            return serialization.decode(request.get_data(), serialization.MSGPACK)
+        except ValueError:
+            abort(400)
+    if not request.is_json:
+        return request.json  # 415 Unsupported Media Type
+    try:
+        return serialization.loads(request.get_data())
+    except ValueError as e:
+        return request.on_json_loading_failed(e)
+
+
+def check_message(message) -> str:
+    """Check that a posted message has all required fields.
+
+    Args:
+        message (dict): the posted message
+
+    Returns:
+        str: the error, None if the message is valid
+
+    """
     if not message:
-        return "No message", 400
+        return "No message"
+    if not isinstance(message, dict):
+        return "Invalid message"
     if not "content" in message:
-        return "No content", 400
+        return "No content"
     if not "sender" in message:
-        return "No sender", 400
+        return "No sender"
     if not "timestamp" in message:
-        return "No timestamp", 400
-    if message["content"].strip() == "":
-        return "OK", 200
-    extra = None
-    if "extra" in message:
-        extra = message["extra"]
+        return "No timestamp"
+    if not isinstance(message["content"], str):
+        return "Invalid content"
+    if not isinstance(message["sender"], str):
+        return "Invalid sender"
+    return None
 
-    # Add message to messages
-    messages = read_messages()
-    messages.append(
-        {
-            "content": profanity.censor(message["content"]),
-            "sender": profanity.censor(message["sender"]),
-            "timestamp": message["timestamp"],
-            "extra": extra,
+
+def censor_message(message: dict) -> dict:
+    """Return the message to store for a posted message.
+
+    An unreadable timestamp is replaced with the time of arrival, so the
+    message expires like any other.
+
+    Args:
+        message (dict): the posted (valid) message
+
+    Returns:
+        dict: the message with censored content and sender
+
+    """
+    timestamp = message["timestamp"]
+    try:
+        message_store.parse_timestamp(timestamp)
+    except ValueError:
+        timestamp = datetime.now(timezone.utc).isoformat()
+    with CENSOR_SECONDS.time():
+        return {
+            "content": get_profanity_filter().censor(message["content"]),
+            "sender": get_profanity_filter().censor_name(message["sender"]),
+            "timestamp": timestamp,
+            "extra": message.get("extra"),
         }
-    )
 
-    # handle commands (starting with !)
-    handle_commands(message, messages)
 
-    save_messages(messages)
-    return "OK", 200
+def read_ndjson(stream):
+    """Parse a stream of JSON documents, one per line.
+
+    Args:
+        stream (Iterable): lines of the stream (bytes)
 
+    Yields:
+        Any: the parsed documents, ValueError for unreadable lines
+
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield serialization.loads(line)
+        except ValueError as e:
+            yield e
 
-def read_messages():
-    """Read messages from the messages file.
+
+def store_batch(items, chunk_size=None, channel: Channel = DEFAULT_CHANNEL) -> list:
+    """Validate, censor and store a batch of posted messages.
+
+    Args:
+        items (Iterable): the posted messages, ValueError for unreadable ones
+        chunk_size (int): store the messages in chunks of this size (for
+            unbounded streams), by default all with a single write
+        channel (Channel): the channel to store the messages in
 
     Returns:
-        list: A list of messages from the file, or an empty list if file not found.
+        list: the result of every posted message
 
     """
-    global CHANNEL_FILE
-    try:
-        f = open(CHANNEL_FILE, "r")
-    except FileNotFoundError:
-        return []
-    try:
-        messages = json.load(f)
-    except json.decoder.JSONDecodeError:
-        messages = []
-    f.close()
-    messages = filter_old_messages(messages)
-    return messages
+    results = []
+    batch = []
+    for item in items:
+        error = "Invalid JSON" if isinstance(item, ValueError) else check_message(item)
+        if error:
+            results.append({"status": "error", "error": error})
+            continue
+        result = {"status": "OK"}
+        results.append(result)
+        if item["content"].strip() == "":
+            continue  # accepted like a single empty message, but not stored
+        batch.append((result, item, censor_message(item)))
+        if chunk_size and len(batch) >= chunk_size:
+            commit_batch(batch, channel)
+            batch = []
+    commit_batch(batch, channel)
+    return results
+
+
+def commit_batch(batch: list, channel: Channel = DEFAULT_CHANNEL) -> None:
+    """Store messages with a single write and queue their commands.
+
+    Args:
+        batch (list): (result, posted message, message to store) tuples,
+            the id of the stored message is added to the result
+        channel (Channel): the channel to store the messages in
+
+    """
+    if not batch:
+        return
+    with STORE_SECONDS.time(CHANNEL_STORE, "append"):
+        channel.get_store().append([stored for _, _, stored in batch])
+    messages_changed(channel)
+
+    def deliver(replies):
+        deliver_replies(replies, channel)
+
+    for result, message, stored in batch:
+        result["id"] = stored["id"]
+        # handle commands (starting with !)
+        if not COMMANDS.submit(message, deliver):
+            deliver(
+                [bot_message("The server is busy, please try again later.", "Server")]
+            )
+
+
+def get_store():
+    """Return the message store of the default channel.
+
+    The store is created on first use.
+
+    Returns:
+        MessageStore: the message store of this channel
+
+    """
+    global STORE
+    if STORE is None:
+        STORE = create_store(
+            CHANNEL_FILE, CHANNEL_LOG_FILE, CHANNEL_DB_FILE, legacy_path=CHANNEL_FILE
+        )
+    return STORE
 
 
-def save_messages(messages):
-    """Save a list of messages to the messages file.
+def get_profanity_filter():
+    """Return the profanity filter of the channel.
+
+    The filter (and better_profanity, which loads its word list on import) is
+    created on first use, see warm_up.
+
+    Returns:
+        ProfanityFilter: the compiled filter
+
+    """
+    global PROFANITY_FILTER
+    if PROFANITY_FILTER is None:
+        try:  # imported as hub_channel.channel (channel.wsgi)
+            from .profanity_filter import ProfanityFilter
+        except ImportError:  # run as script or via flask --app channel.py
+            from profanity_filter import ProfanityFilter
+        PROFANITY_FILTER = ProfanityFilter.from_profanity()
+    return PROFANITY_FILTER
+
+
+def create_store(json_path: str, log_path: str, db_path: str, legacy_path=None):
+    """Create a message store of the type configured by CHANNEL_STORE.
+
+    Args:
+        json_path (str): file of the "json" store
+        log_path (str): file of the "log" store
+        db_path (str): database of the "sqlite" store
+        legacy_path (str): JSON file the "log" and "sqlite" stores migrate from
+
+    Returns:
+        MessageStore: the message store
+
+    """
+    if CHANNEL_STORE == "json":
+        return JsonFileStore(json_path, max_age=max_message_age())
+    if CHANNEL_STORE == "sqlite":
+        return SQLiteStore(
+            db_path,
+            max_age=max_message_age(),
+            expire_interval=CHANNEL_EXPIRE_INTERVAL,
+            legacy_path=legacy_path,
+            fsync=CHANNEL_FSYNC,
+        )
+    return LogStore(
+        log_path,
+        max_age=max_message_age(),
+        compact_interval=CHANNEL_COMPACT_INTERVAL,
+        expire_interval=CHANNEL_EXPIRE_INTERVAL,
+        legacy_path=legacy_path,
+        fsync=CHANNEL_FSYNC,
+    )
+
+
+def read_messages(channel: Channel = DEFAULT_CHANNEL):
+    """Read messages from the message store.
+
+    Args:
+        channel (Channel): the channel
+
+    Returns:
+        list: A list of messages from the store, or an empty list if there are none.
+
+    """
+    with STORE_SECONDS.time(CHANNEL_STORE, "read"):
+        return channel.get_store().read()
+
+
+def save_messages(messages, channel: Channel = DEFAULT_CHANNEL):
+    """Replace the content of the message store with a list of messages.
 
     Args:
         messages (list): The list of messages to save.
+        channel (Channel): the channel
 
     Returns:
         None
 
     """
-    global CHANNEL_FILE
-    with open(CHANNEL_FILE, "w") as f:
-        messages = filter_old_messages(messages)
-        json.dump(messages, f)
+    with STORE_SECONDS.time(CHANNEL_STORE, "replace"):
+        channel.get_store().replace(messages)
+    messages_changed(channel)
+
+
+@app.cli.command("compact_messages")
+def compact_messages_command():
+    """Drop expired messages from the message stores of all channels."""
+    for channel in served_channels():
+        channel.get_store().compact()
+
+
+@app.cli.command("import_messages")
+@click.argument("path", default=CHANNEL_FILE)
+def import_messages_command(path):
+    """Replace the stored messages with the ones from a JSON file."""
+    print(f"Imported {get_store().import_json(path)} messages from {path}")
+
+
+@app.cli.command("export_messages")
+@click.argument("path", default=CHANNEL_FILE)
+def export_messages_command(path):
+    """Export the stored messages to a JSON file."""
+    print(f"Exported {get_store().export_json(path)} messages to {path}")
+
+
+def warm_up() -> None:
+    """Prepare a new worker for traffic (called by channel.wsgi before serving).
+
+    Builds the profanity filter, opens the message stores of all channels and
+    caches their message lists in READ_CACHE, and creates the shared HTTP
+    client, so the first requests don't pay for it.
+    """
+    get_profanity_filter()
+    http_client.get_client()
+    for channel in served_channels():
+        read_encoded_messages(channel)
+
+
+def max_message_age() -> float:
+    """Return the age in seconds after which messages get deleted.
+
+    Returns:
+        float: CHANNEL_MAX_MESSAGE_AGE (days) in seconds
+
+    """
+    return CHANNEL_MAX_MESSAGE_AGE * 24 * 3600
 
 
 def filter_old_messages(messages: list) -> list:
@@ -355,22 +1237,16 @@ def filter_old_messages(messages: list) -> list:
         list: filtered messages
 
     """
-    cutoff = datetime.now(timezone.utc) - timedelta(days=CHANNEL_MAX_MESSAGE_AGE)
-    filtered_messages = []
-    for message in messages:
-        timestamp = message["timestamp"]
-        iso_message_time = datetime.fromisoformat(timestamp.rstrip("Z"))
-        if iso_message_time.tzinfo is None:
-            iso_message_time = iso_message_time.replace(tzinfo=timezone.utc)
-        if iso_message_time >= cutoff or (
-            "extra" in message and message["extra"] == "INIT"
-        ):
-            filtered_messages.append(message)
-    return filtered_messages
+    return message_store.filter_old_messages(messages, max_message_age())
 
 
-def init_message():
-    """Save initial message."""
+def init_message(channel: Channel = DEFAULT_CHANNEL):
+    """Save initial message.
+
+    Args:
+        channel (Channel): the channel
+
+    """
     inital_message = {
         "content": """Welcome to our server. Here we discuss everything that has something to do with the weather. No matter if it's in your area or anywhere in the world.
         
@@ -379,7 +1255,7 @@ def init_message():
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "extra": "INIT",
     }
-    save_messages([inital_message])
+    save_messages([inital_message], channel)
 
 
 # Start development web server
@@ -387,6 +1263,6 @@ def init_message():
 # to register channel with hub
 
 if __name__ == "__main__":
-    init_message()
-    profanity.load_censor_words()
+    for channel in served_channels():
+        init_message(channel)
     # app.run(port=5001, debug=True)
@@ -1,50 +1,215 @@
 """Implementation of a client of a hub-channel application."""
 
-from flask import Flask, request, render_template, url_for, redirect
+from flask import Flask, request, render_template, url_for, redirect, jsonify
 from flask_cors import CORS
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 import urllib.parse
 import datetime
+import requests
+import threading
+import time
+
+try:  # imported as hub_channel.client (client.wsgi)
+    from . import http_client
+    from . import metrics
+except ImportError:  # run as script or via flask --app client.py
+    import http_client
+    import metrics
 
 app = Flask(__name__)
 CORS(app)
+metrics.instrument(app, "client")
 
 HUB_AUTHKEY = "Crr-K24d-2N"
 HUB_URL = "http://vm146.rz.uni-osnabrueck.de/hub"
 
-CHANNELS = None
-LAST_CHANNEL_UPDATE = None
+CHANNELS_MAX_AGE = 60  # seconds the channel directory is used before revalidation
+CHANNELS_SUBSCRIBE = True  # follow the change feed of the hub in the background
+CHANNELS_FEED_WAIT = 25  # seconds a change feed request may be held by the hub
+CHANNELS_RETRY_INTERVAL = 5  # seconds between attempts to reach the hub after errors
+OVERVIEW_WORKERS = 16  # parallel channel requests of /channels/overview (all callers)
+OVERVIEW_DEADLINE = 3  # seconds until /channels/overview answers without slow channels
+OVERVIEW_MESSAGES = 5  # default number of latest messages per channel in the overview
+OVERVIEW_EXECUTOR = None
 
 
-def update_channels():
-    """Fetch and update the list of channels from the server.
+class HubError(Exception):
+    """Raised if the channel directory can't be fetched from the hub."""
 
-    This function checks if the channels have been updated within the last 60 seconds.
-    If not, it makes a GET request to the server to fetch the latest channels.
 
-    Returns:
-        list: Updated channels if successful, or an error message if unsuccessful.
+class ChannelIndex(object):
+    """Local copy of the channel directory of the hub, keyed by endpoint.
+
+    The copy is loaded once and then updated incrementally from the change
+    feed of the hub (GET /channels/changes), which a background thread
+    long-polls, so new channels and health changes arrive within moments.
+    Once loaded, lookups never wait for the hub: if the copy wasn't updated
+    for CHANNELS_MAX_AGE seconds (e.g. because the hub is slow), it is still
+    used while a refresh runs in the background (stale-while-revalidate).
+    Hubs without a change feed are asked for the whole list instead.
 
+    Updates replace the dict of channels instead of changing it, so the dict
+    returned by ``current`` stays unchanged while a request uses it.
     """
-    global CHANNELS, LAST_CHANNEL_UPDATE
-    if (
-        CHANNELS
-        and LAST_CHANNEL_UPDATE
-        and (datetime.datetime.now() - LAST_CHANNEL_UPDATE).seconds < 60
-    ):
-        return CHANNELS
-    # fetch list of channels from server
-    response = requests.get(
-        HUB_URL + "/channels", headers={"Authorization": "authkey " + HUB_AUTHKEY}
-    )
-    if response.status_code != 200:
-        return "Error fetching channels: " + str(response.text), 400
-    channels_response = response.json()
-    if not "channels" in channels_response:
-        return "No channels in response", 400
-    CHANNELS = channels_response["channels"]
-    LAST_CHANNEL_UPDATE = datetime.datetime.now()
-    return CHANNELS
+
+    def __init__(self, subscribe=None, clock=time.monotonic):
+        """Create an empty index.
+
+        Args:
+            subscribe (bool): follow the change feed in a background thread,
+                defaults to CHANNELS_SUBSCRIBE
+            clock (callable): returns the current time in seconds
+
+        """
+        self.subscribe = CHANNELS_SUBSCRIBE if subscribe is None else subscribe
+        self.clock = clock
+        self.channels = {}  # endpoint -> channel details
+        self.version = None  # version of the hub's directory, None if unknown
+        self.updated = None  # clock() of the last update
+        self.refreshing = False
+        self.subscriber = None
+        self.lock = threading.Lock()
+
+    def fetch(self, wait=0) -> bool:
+        """Fetch the changes since the last update from the hub and apply them.
+
+        Args:
+            wait (float): seconds the hub may hold the request until there
+                are changes
+
+        Raises:
+            HubError: if the hub can't be reached or sends an error.
+
+        Returns:
+            bool: False if the hub has no change feed and the whole list was
+                fetched instead
+
+        """
+        headers = {"Authorization": "authkey " + HUB_AUTHKEY}
+        params = {"wait": wait}
+        if self.version is not None:
+            params["since"] = self.version
+        try:
+            response = http_client.get(
+                HUB_URL + "/channels/changes",
+                params=params,
+                headers=headers,
+                timeout=(http_client.HTTP_TIMEOUT[0], wait + 10),
+            )
+            feed = response.status_code != 404
+            if not feed:
+                response = http_client.get(HUB_URL + "/channels", headers=headers)
+        except requests.exceptions.RequestException as e:
+            raise HubError(f"Error fetching channels: {e}") from e
+        if response.status_code != 200:
+            raise HubError("Error fetching channels: " + str(response.text))
+        data = response.json()
+        if not feed:
+            if "channels" not in data:
+                raise HubError("No channels in response")
+            data = {"version": None, "reset": True, "channels": data["channels"]}
+        self.apply(data)
+        return feed
+
+    def apply(self, feed: dict) -> None:
+        """Apply a response of the change feed.
+
+        Args:
+            feed (dict): a snapshot (``reset``) or the changes since the
+                version of the index
+
+        """
+        with self.lock:
+            if feed.get("reset"):
+                channels = {c["endpoint"]: c for c in feed["channels"]}
+            elif self.version is not None and feed["version"] < self.version:
+                return  # an older response that arrived late
+            elif feed.get("changes"):
+                channels = dict(self.channels)  # copy on write
+            else:
+                channels = self.channels
+            for change in feed.get("changes", []):
+                if change.get("deleted"):
+                    channels.pop(change["endpoint"], None)
+                else:
+                    channels[change["endpoint"]] = change
+            self.channels = channels
+            self.version = feed["version"]
+            self.updated = self.clock()
+
+    def current(self) -> dict:
+        """Return the channel directory, loading or revalidating it as needed.
+
+        Raises:
+            HubError: if the directory was never loaded and can't be fetched.
+
+        Returns:
+            dict: endpoints mapped to channel details (a snapshot, never
+                changed by later updates)
+
+        """
+        if self.updated is None:
+            self.fetch()  # nothing to serve yet, load the directory now
+        elif self.clock() - self.updated >= CHANNELS_MAX_AGE:
+            self.revalidate()
+        if self.subscribe:
+            self.start()
+        return self.channels
+
+    def get(self, endpoint: str):
+        """Return the details of a channel.
+
+        Args:
+            endpoint (str): endpoint of the channel
+
+        Raises:
+            HubError: if the directory was never loaded and can't be fetched.
+
+        Returns:
+            dict: the channel, None if the hub doesn't know it
+
+        """
+        return self.current().get(endpoint)
+
+    def revalidate(self) -> None:
+        """Update the index in a background thread (if not already running)."""
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.fetch()
+            except HubError as e:
+                print(e)
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=refresh, name="channel-refresh", daemon=True).start()
+
+    def start(self) -> None:
+        """Start following the change feed (if not already running)."""
+        with self.lock:
+            if self.subscriber and self.subscriber.is_alive():
+                return
+            self.subscriber = threading.Thread(
+                target=self.run, name="channel-feed", daemon=True
+            )
+            self.subscriber.start()
+
+    def run(self) -> None:
+        """Long-poll the change feed of the hub forever."""
+        while True:
+            try:
+                if not self.fetch(CHANNELS_FEED_WAIT):
+                    time.sleep(CHANNELS_MAX_AGE)  # no feed, poll the list
+            except HubError as e:
+                print(e)
+                time.sleep(CHANNELS_RETRY_INTERVAL)
+
+
+CHANNEL_INDEX = ChannelIndex()
 
 
 @app.route("/")
@@ -73,15 +238,16 @@ def show_channel():
     show_channel = request.args.get("channel", None)
     if not show_channel:
         return "No channel specified", 400
-    channel = None
-    for c in update_channels():
-        if c["endpoint"] == urllib.parse.unquote(show_channel):
-            channel = c
-            break
+    try:
+        channel = CHANNEL_INDEX.get(urllib.parse.unquote(show_channel))
+    except HubError as e:
+        return str(e), 400
     if not channel:
         return "Channel not found", 404
-    response = requests.get(
-        channel["endpoint"], headers={"Authorization": "authkey " + channel["authkey"]}
+    response = http_client.get(
+        channel["endpoint"],
+        headers={"Authorization": "authkey " + channel["authkey"]},
+        circuit=channel["endpoint"],
     )
     if response.status_code != 200:
         return "Error fetching messages: " + str(response.text), 400
@@ -104,19 +270,19 @@ def post_message():
     post_channel = request.form["channel"]
     if not post_channel:
         return "No channel specified", 400
-    channel = None
-    for c in update_channels():
-        if c["endpoint"] == urllib.parse.unquote(post_channel):
-            channel = c
-            break
+    try:
+        channel = CHANNEL_INDEX.get(urllib.parse.unquote(post_channel))
+    except HubError as e:
+        return str(e), 400
     if not channel:
         return "Channel not found", 404
     message_content = request.form["content"]
     message_sender = request.form["sender"]
     message_timestamp = datetime.datetime.now().isoformat()
-    response = requests.post(
+    response = http_client.post(
         channel["endpoint"],
         headers={"Authorization": "authkey " + channel["authkey"]},
+        circuit=channel["endpoint"],
         json={
             "content": message_content,
             "sender": message_sender,
@@ -130,6 +296,150 @@ def post_message():
     )
 
 
+def get_overview_executor() -> ThreadPoolExecutor:
+    """Return the thread pool of /channels/overview, created on first use.
+
+    Returns:
+        ThreadPoolExecutor: pool of OVERVIEW_WORKERS threads
+
+    """
+    global OVERVIEW_EXECUTOR
+    if OVERVIEW_EXECUTOR is None:
+        OVERVIEW_EXECUTOR = ThreadPoolExecutor(
+            max_workers=OVERVIEW_WORKERS, thread_name_prefix="overview"
+        )
+    return OVERVIEW_EXECUTOR
+
+
+def fetch_channel_summary(channel: dict, messages: int, deadline: float) -> dict:
+    """Request the status and the latest messages of a channel.
+
+    Args:
+        channel (dict): details of the channel
+        messages (int): number of latest messages, 0 for only the status
+        deadline (float): time.monotonic() value when the overview is sent
+
+    Returns:
+        dict: the channel details with ``active``, the HTTP ``status`` and
+            ``messages``, or an ``error``
+
+    """
+    result = dict(channel)
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:  # waited too long for a free worker
+        return dict(result, active=None, error="Deadline exceeded")
+    headers = {"Authorization": "authkey " + channel["authkey"]}
+    timeout = (min(http_client.HTTP_TIMEOUT[0], timeout), timeout)
+    try:
+        if messages:
+            response = http_client.get(
+                channel["endpoint"],
+                params={"limit": messages},
+                headers=headers,
+                timeout=timeout,
+                circuit=channel["endpoint"],
+            )
+        else:
+            response = http_client.request(
+                "HEAD",
+                channel["endpoint"],
+                headers=headers,
+                timeout=timeout,
+                circuit=channel["endpoint"],
+            )
+    except requests.exceptions.RequestException as e:
+        return dict(result, active=False, error=str(e))
+    result["active"] = response.status_code == 200
+    result["status"] = response.status_code
+    if messages and result["active"]:
+        try:
+            result["messages"] = response.json()[-messages:]
+        except (ValueError, TypeError, KeyError):
+            result["error"] = "Invalid messages"
+    return result
+
+
+@app.route("/channels/overview")
+def channel_overview():
+    """Return the status and latest messages of many channels at once.
+
+    The channels (``channel`` parameters, all known channels by default)
+    are requested in parallel by a pool of OVERVIEW_WORKERS threads. The
+    response is sent after OVERVIEW_DEADLINE seconds at the latest; channels
+    that haven't answered by then are included with ``active`` null and an
+    ``error``, and ``complete`` is false.
+
+    Query parameters are ``channel`` (endpoint, repeatable) and
+    ``messages`` (number of latest messages per channel, 0 for the status
+    only, default OVERVIEW_MESSAGES).
+
+    Returns:
+        JSON: the channels with their status and messages.
+
+    """
+    messages = max(request.args.get("messages", OVERVIEW_MESSAGES, type=int), 0)
+    endpoints = [urllib.parse.unquote(e) for e in request.args.getlist("channel")]
+    try:
+        directory = CHANNEL_INDEX.current()
+    except HubError as e:
+        return str(e), 400
+    if not endpoints:
+        endpoints = list(directory)
+    deadline = time.monotonic() + OVERVIEW_DEADLINE
+    executor = get_overview_executor()
+    futures = {
+        endpoint: executor.submit(
+            fetch_channel_summary, directory[endpoint], messages, deadline
+        )
+        for endpoint in endpoints
+        if endpoint in directory
+    }
+    wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+    channels = []
+    for endpoint in endpoints:
+        future = futures.get(endpoint)
+        if future is None:
+            channels.append({"endpoint": endpoint, "error": "Channel not found"})
+        elif future.done() and future.exception():
+            channels.append(dict(directory[endpoint], error=str(future.exception())))
+        elif future.done():
+            channels.append(future.result())
+        else:
+            future.cancel()  # still queued: don't request it anymore
+            channels.append(
+                dict(directory[endpoint], active=None, error="Deadline exceeded")
+            )
+    complete = all(f.done() and not f.cancelled() for f in futures.values())
+    return jsonify(channels=channels, complete=complete)
+
+
+@app.route("/stats/http")
+def http_stats():
+    """Return statistics of the outbound HTTP connection pools.
+
+    Returns:
+        JSON: request counters, circuit states and connection reuse per host.
+
+    """
+    return jsonify(http_client.stats())
+
+
+def warm_up() -> None:
+    """Prepare a new worker for traffic (called by client.wsgi before serving).
+
+    Compiles the templates, creates the shared HTTP client and loads the
+    channel directory into CHANNEL_INDEX, so the first requests don't pay for
+    it. If the hub can't be reached, the first request tries again.
+    """
+    for template in ("react_client.html", "channel.html"):
+        app.jinja_env.get_template(template)
+    http_client.get_client()
+    try:
+        CHANNEL_INDEX.current()
+    except HubError as e:
+        print(e)
+
+
 # Start development web server
 if __name__ == "__main__":
     app.run(port=5005, debug=True)
@@ -0,0 +1,224 @@
+"""commands.py - background execution of chat commands (messages starting with !)."""
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CommandJob(object):
+    """A command message waiting for or being handled by a worker."""
+
+    def __init__(self, message: dict, deadline: float, deliver):
+        """Create a job.
+
+        Args:
+            message (dict): the message containing the command
+            deadline (float): time.monotonic() value when the command times out
+            deliver (callable): called with the list of replies
+
+        """
+        self.message = message
+        self.deadline = deadline
+        self.deliver = deliver
+        self.done = False
+
+
+class CommandQueue(object):
+    """Registry of command handlers executed by a bounded pool of workers.
+
+    A handler is called with the message and the text after the command name
+    and returns a list of reply messages, which are passed to ``deliver``
+    once they are ready. If a handler raises an exception or doesn't finish
+    within ``timeout`` seconds, the replies of ``fallback`` are delivered
+    instead (a late result is dropped).
+
+    At most ``max_pending`` commands are queued or running; ``submit``
+    refuses further commands until some are finished. With ``synchronous``
+    set, commands are handled immediately in the calling thread, which makes
+    tests with stub handlers deterministic.
+    """
+
+    def __init__(
+        self,
+        deliver,
+        fallback,
+        workers=4,
+        max_pending=64,
+        timeout=10.0,
+        synchronous=False,
+    ):
+        """Create a command queue.
+
+        Args:
+            deliver (callable): called with the list of replies of a command
+            fallback (callable): called with the message and the reason of a
+                failure, returns the replies to deliver instead
+            workers (int): number of worker threads
+            max_pending (int): maximum number of queued and running commands
+            timeout (float): seconds until a command times out
+            synchronous (bool): handle commands in the calling thread
+
+        """
+        self.deliver = deliver
+        self.fallback = fallback
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.handlers = {}
+        self.default = None
+        self.pending = 0
+        self.executor = None
+        self.deadlines = []  # heap of (deadline, sequence number, job)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.watchdog = None
+
+    def register(self, name: str, handler) -> None:
+        """Register the handler of a command.
+
+        Args:
+            name (str): the command including the "!", e.g. "!weather"
+            handler (callable): called with the message and the argument text
+
+        """
+        self.handlers[name] = handler
+
+    def parse(self, message: dict):
+        """Find the handler of a message.
+
+        Args:
+            message (dict): a message
+
+        Returns:
+            tuple: (handler, argument), or None if the message isn't a
+                command or there is no handler for it.
+
+        """
+        content = message["content"].strip()
+        if not content.startswith("!"):
+            return None
+        name, _, argument = content.partition(" ")
+        handler = self.handlers.get(name, self.default)
+        if handler is None:
+            return None
+        return handler, argument.strip()
+
+    def run(self, message: dict) -> list:
+        """Handle a command in the calling thread.
+
+        Args:
+            message (dict): the message containing the command
+
+        Returns:
+            list: the replies, or the replies of ``fallback`` if it failed
+
+        """
+        parsed = self.parse(message)
+        if parsed is None:
+            return []
+        handler, argument = parsed
+        try:
+            return handler(message, argument)
+        except Exception as e:
+            return self.fallback(message, str(e))
+
+    def submit(self, message: dict, deliver=None) -> bool:
+        """Queue a command for a worker.
+
+        Args:
+            message (dict): the message, ignored if it isn't a command
+            deliver (callable): called with the replies instead of the
+                ``deliver`` of the queue (e.g. to reply in another channel)
+
+        Returns:
+            bool: False if the command was refused because too many
+                commands are pending, True otherwise.
+
+        """
+        if self.parse(message) is None:
+            return True
+        deliver = deliver or self.deliver
+        if self.synchronous:
+            deliver(self.run(message))
+            return True
+        with self.condition:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            job = CommandJob(message, time.monotonic() + self.timeout, deliver)
+            heapq.heappush(self.deadlines, (job.deadline, next(self.sequence), job))
+            self.condition.notify_all()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="command"
+                )
+                self.watchdog = threading.Thread(
+                    target=self.watch, name="command-watchdog", daemon=True
+                )
+                self.watchdog.start()
+        self.executor.submit(self.execute, job)
+        return True
+
+    def execute(self, job: CommandJob) -> None:
+        """Handle a queued command in a worker thread.
+
+        Args:
+            job (CommandJob): the queued command
+
+        """
+        try:
+            self.finish(job, self.run(job.message))
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def finish(self, job: CommandJob, replies: list) -> None:
+        """Deliver the replies of a command, unless it was already finished.
+
+        Args:
+            job (CommandJob): the command
+            replies (list): its replies
+
+        """
+        with self.condition:
+            if job.done:
+                return
+            job.done = True
+        try:
+            job.deliver(replies)
+        except Exception as e:
+            print(f"Error delivering command replies: {e}")
+
+    def watch(self) -> None:
+        """Deliver the fallback replies of commands that exceed their deadline."""
+        while True:
+            with self.condition:
+                while self.deadlines and self.deadlines[0][2].done:
+                    heapq.heappop(self.deadlines)
+                if not self.deadlines:
+                    self.condition.wait()
+                    continue
+                deadline, _, job = self.deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                heapq.heappop(self.deadlines)
+            self.finish(job, self.fallback(job.message, "timed out"))
+
+    def drain(self, timeout=None) -> bool:
+        """Wait until all queued and running commands are finished.
+
+        Args:
+            timeout (float): maximum seconds to wait
+
+        Returns:
+            bool: True if no command is pending anymore
+
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout)
@@ -0,0 +1,147 @@
+"""compression.py - content negotiation and memoized gzip/brotli response bodies."""
+
+import gzip
+import threading
+
+try:  # optional, only gzip is offered without it
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = 1024  # bytes, smaller bodies are sent uncompressed
+GZIP_LEVEL = 1  # 1 (fast) .. 9 (small), message lists change often
+BROTLI_QUALITY = 4  # 0 (fast) .. 11 (small)
+
+
+def available_encodings() -> tuple:
+    """Return the supported content encodings, preferred first.
+
+    Returns:
+        tuple: "br" (if brotli is installed) and "gzip"
+
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding(request) -> str:
+    """Choose the content encoding of a response from its Accept-Encoding.
+
+    Args:
+        request (flask.Request): the request
+
+    Returns:
+        str: "br" or "gzip", None to send the body uncompressed
+
+    """
+    accepted = request.accept_encodings
+    encodings = [e for e in available_encodings() if accepted[e] > 0]
+    if not encodings:
+        return None
+    # the client's preference first, ours on ties
+    return max(encodings, key=lambda e: accepted[e])
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data.
+
+    Args:
+        data (bytes): the data
+        encoding (str): "br" or "gzip"
+
+    Returns:
+        bytes: the compressed data
+
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # mtime=0: the same data always gives the same bytes
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class Body(object):
+    """A response body and its compressed variants, each compressed once.
+
+    Cached responses keep their Body, so all requests for the same version
+    of the data share one compression per encoding.
+    """
+
+    def __init__(self, data: bytes):
+        """Create a body.
+
+        Args:
+            data (bytes): the uncompressed body
+
+        """
+        self.data = data
+        self.variants = {}  # encoding -> compressed data
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return the size of the uncompressed body."""
+        return len(self.data)
+
+    def encode(self, encoding: str) -> bytes:
+        """Return the body in an encoding, compressing it on first use.
+
+        Args:
+            encoding (str): "br", "gzip" or None for the uncompressed body
+
+        Returns:
+            bytes: the (compressed) body
+
+        """
+        if encoding is None:
+            return self.data
+        with self.lock:
+            variant = self.variants.get(encoding)
+            if variant is None:
+                variant = self.variants[encoding] = compress(self.data, encoding)
+            return variant
+
+
+def negotiate(request, body: Body, etag: str) -> tuple:
+    """Choose the encoding of a body for a request.
+
+    Bodies smaller than COMPRESSION_MIN_SIZE are never compressed.
+
+    Args:
+        request (flask.Request): the request
+        body (Body): the response body
+        etag (str): the ETag of the uncompressed body
+
+    Returns:
+        tuple: the encoding (None for uncompressed) and its ETag (with the
+            encoding appended, since the bytes differ)
+
+    """
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return None, etag
+    encoding = choose_encoding(request)
+    return encoding, etag if encoding is None else f"{etag}-{encoding}"
+
+
+def make_response(app, request, body: Body, etag: str, mimetype="application/json"):
+    """Create the response of a body in the encoding accepted by the client.
+
+    Args:
+        app (flask.Flask): the app
+        request (flask.Request): the request
+        body (Body): the response body
+        etag (str): the ETag of the uncompressed body
+        mimetype (str): the type of the body
+
+    Returns:
+        flask.Response: the (compressed) body, or a 304 if the client's
+            If-None-Match matches the ETag of the chosen encoding
+
+    """
+    encoding, etag = negotiate(request, body, etag)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body.encode(encoding), mimetype=mimetype)
+        if encoding is not None:
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,378 @@
+"""http_client.py - shared outbound HTTP client of hub, channel and client."""
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:  # imported as hub_channel.http_client
+    from . import metrics
+except ImportError:  # imported by a script in the repository directory
+    import metrics
+
+HTTP_TIMEOUT = (3, 10)  # default (connect, read) timeout in seconds
+HTTP_RETRIES = 2  # retries of failed connections and idempotent requests
+HTTP_BACKOFF = 0.2  # backoff factor between retries in seconds
+HTTP_POOL_SIZE = 10  # kept-alive connections per host
+HTTP_POOL_HOSTS = 50  # number of hosts with a connection pool
+BREAKER_THRESHOLD = 5  # consecutive failures that open the circuit of a host
+BREAKER_RESET = 30  # seconds until an open circuit lets a trial request through
+
+CLIENT = None
+PROBE_CLIENT = None
+REQUEST_SECONDS = metrics.Histogram(
+    "http_client_request_duration_seconds",
+    "Duration of outbound requests (including retries).",
+    ("host",),
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host after repeated failures.
+
+    Failures are connection errors and timeouts; a host answering (even with
+    5xx) is reachable. After ``threshold`` consecutive failures the circuit
+    opens and requests are rejected. After ``reset`` seconds a single trial request is let
+    through; its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, threshold=None, reset=None, clock=time.monotonic):
+        """Create a closed circuit breaker.
+
+        Args:
+            threshold (int): consecutive failures that open the circuit
+            reset (float): seconds until a trial request is let through
+            clock (callable): returns the current time in seconds
+
+        """
+        self.threshold = threshold or BREAKER_THRESHOLD
+        self.reset = BREAKER_RESET if reset is None else reset
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Return "closed", "open" or "half-open"."""
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent.
+
+        Returns:
+            bool: False while the circuit is open
+
+        """
+        with self.lock:
+            if self.state != "half-open":
+                return self.state == "closed"
+            # let one trial request through, keep the others out
+            self.opened_at = self.clock()
+            return True
+
+    def record_success(self) -> None:
+        """Close the circuit after a successful request."""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        """Count a failed request, opening the circuit at the threshold."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+class HttpClient(object):
+    """HTTP client with kept-alive connection pools, retries and circuit breakers.
+
+    All requests go through one requests.Session, which keeps a pool of
+    connections per host. Failed connections and idempotent requests
+    answered with 502/503/504 are retried with exponential backoff. Hosts that
+    can't be reached or keep timing out are cut off by a per-host
+    CircuitBreaker. Requests to services sharing a host (e.g. channels) can
+    pass their own ``circuit``, so one of them failing doesn't cut off the
+    others.
+    """
+
+    def __init__(
+        self,
+        timeout=None,
+        retries=None,
+        backoff=None,
+        pool_size=None,
+        pool_hosts=None,
+        circuit_breakers=True,
+    ):
+        """Create a client, parameters default to the module settings.
+
+        Args:
+            timeout (tuple): default (connect, read) timeout in seconds
+            retries (int): retries of failed requests
+            backoff (float): backoff factor between retries in seconds
+            pool_size (int): kept-alive connections per host
+            pool_hosts (int): number of hosts with a connection pool
+            circuit_breakers (bool): reject requests to failing hosts
+
+        """
+        self.timeout = timeout or HTTP_TIMEOUT
+        retry = Retry(
+            total=HTTP_RETRIES if retries is None else retries,
+            backoff_factor=HTTP_BACKOFF if backoff is None else backoff,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_hosts or HTTP_POOL_HOSTS,
+            pool_maxsize=pool_size or HTTP_POOL_SIZE,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.circuit_breakers = circuit_breakers
+        self.breakers = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        """Return the circuit breaker of a host.
+
+        Args:
+            host (str): host (and port) of the URL, or the circuit passed
+                to request
+
+        Returns:
+            CircuitBreaker: the breaker, created on first use
+
+        """
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker()
+                self.counts[host] = {"requests": 0, "failures": 0, "rejected": 0}
+            return self.breakers[host]
+
+    def count(self, host: str, key: str) -> None:
+        """Increment a request counter of a host.
+
+        Args:
+            host (str): host (and port) of the URL, or the circuit passed
+                to request
+            key (str): "requests", "failures" or "rejected"
+
+        """
+        with self.lock:
+            self.counts[host][key] += 1
+
+    def request(
+        self, method: str, url: str, circuit=None, **kwargs
+    ) -> requests.Response:
+        """Send a request, like requests.request.
+
+        Args:
+            method (str): HTTP method
+            url (str): URL of the request
+            circuit (str): key of the circuit breaker (and counters),
+                defaults to the host of the URL
+            **kwargs: further arguments of requests.Session.request
+
+        Raises:
+            CircuitOpenError: if the circuit of the host is open.
+            requests.exceptions.RequestException: if the request fails.
+
+        Returns:
+            requests.Response: the response
+
+        """
+        host = urlsplit(url).netloc
+        circuit = circuit or host
+        breaker = self.breaker(circuit)
+        if self.circuit_breakers and not breaker.allow():
+            self.count(circuit, "rejected")
+            raise CircuitOpenError(f"Circuit for {circuit} is open")
+        kwargs.setdefault("timeout", self.timeout)
+        self.count(circuit, "requests")
+        try:
+            with REQUEST_SECONDS.time(host):
+                response = self.session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.count(circuit, "failures")
+            if self.circuit_breakers:
+                breaker.record_failure()
+            raise
+        except requests.exceptions.RequestException:
+            self.count(circuit, "failures")  # e.g. an invalid URL, not the host
+            raise
+        if response.status_code >= 500:
+            self.count(circuit, "failures")
+        if self.circuit_breakers:
+            breaker.record_success()  # the host answered
+        return response
+
+    def stats(self) -> dict:
+        """Return request, circuit and connection pool statistics per host.
+
+        Returns:
+            dict: hosts mapped to their counters, circuit state, number of
+                opened connections and the connection reuse rate
+
+        """
+        result = {}
+        with self.lock:
+            for host, counts in self.counts.items():
+                result[host] = dict(counts, circuit=self.breakers[host].state)
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = (
+                pool.host
+                if pool.port in (None, 80, 443)
+                else (f"{pool.host}:{pool.port}")
+            )
+            stats = result.setdefault(host, {})
+            stats["connections"] = stats.get("connections", 0) + pool.num_connections
+            stats["pool_requests"] = stats.get("pool_requests", 0) + pool.num_requests
+        for stats in result.values():
+            if stats.get("pool_requests"):
+                stats["reuse_rate"] = 1 - stats["connections"] / stats["pool_requests"]
+        return result
+
+
+def get_client() -> HttpClient:
+    """Return the shared client, created on first use.
+
+    Returns:
+        HttpClient: the client shared by all requests of this process
+
+    """
+    global CLIENT
+    if CLIENT is None:
+        CLIENT = HttpClient()
+    return CLIENT
+
+
+def get_probe_client() -> HttpClient:
+    """Return the client of health checks, created on first use.
+
+    Health checks report the state of every single service within their
+    timeout, so the client has no circuit breakers and doesn't retry.
+
+    Returns:
+        HttpClient: the client shared by all health checks of this process
+
+    """
+    global PROBE_CLIENT
+    if PROBE_CLIENT is None:
+        PROBE_CLIENT = HttpClient(retries=0, circuit_breakers=False)
+    return PROBE_CLIENT
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request with the shared client.
+
+    Args:
+        method (str): HTTP method
+        url (str): URL of the request
+        **kwargs: further arguments of requests.Session.request
+
+    Returns:
+        requests.Response: the response
+
+    """
+    return get_client().request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Send a GET request with the shared client, like requests.get.
+
+    Args:
+        url (str): URL of the request
+        **kwargs: further arguments of requests.Session.request
+
+    Returns:
+        requests.Response: the response
+
+    """
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Send a POST request with the shared client, like requests.post.
+
+    Args:
+        url (str): URL of the request
+        **kwargs: further arguments of requests.Session.request
+
+    Returns:
+        requests.Response: the response
+
+    """
+    return request("POST", url, **kwargs)
+
+
+def stats() -> dict:
+    """Return the statistics of the shared client and the health checks.
+
+    Returns:
+        dict: see HttpClient.stats, the counters of health checks prefixed
+            with ``probe_``
+
+    """
+    result = get_client().stats()
+    if PROBE_CLIENT is not None:
+        for host, probes in PROBE_CLIENT.stats().items():
+            result.setdefault(host, {}).update(
+                {f"probe_{k}": v for k, v in probes.items() if k != "circuit"}
+            )
+    return result
+
+
+def collect_metrics():
+    """Yield the statistics of the shared client as metrics.
+
+    Yields:
+        tuple: (name, type, help, samples), see metrics.Registry.add_collector
+
+    """
+    if CLIENT is None:
+        return
+    hosts = CLIENT.stats()
+    for key, documentation in (
+        ("requests", "Outbound requests."),
+        ("failures", "Outbound requests that failed or were answered with 5xx."),
+        ("rejected", "Outbound requests rejected by an open circuit."),
+        ("connections", "Connections opened."),
+    ):
+        yield (
+            f"http_client_{key}_total",
+            "counter",
+            documentation,
+            [({"host": host}, stats.get(key, 0)) for host, stats in hosts.items()],
+        )
+    yield (
+        "http_client_circuit_open",
+        "gauge",
+        "1 if the circuit of the host is open or half-open.",
+        [
+            ({"host": host}, int(stats.get("circuit", "closed") != "closed"))
+            for host, stats in hosts.items()
+        ],
+    )
+
+
+metrics.REGISTRY.add_collector(collect_metrics)
@@ -1,11 +1,37 @@
 """Hub implementation of a hub-channel application."""
 
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, url_for
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-import json
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+import atexit
+import click
 import datetime
+import hashlib
+import os
+import random
 import requests
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, every process runs the heartbeat
+    fcntl = None
+
+try:  # imported as hub_channel.hub (hub.wsgi)
+    from . import compression
+    from . import http_client
+    from . import metrics
+    from . import serialization
+    from .broadcast import Broadcaster
+except ImportError:  # run as script or via flask --app hub.py
+    import compression
+    import http_client
+    import metrics
+    import serialization
+    from broadcast import Broadcaster
 
 db = SQLAlchemy()
 
@@ -17,16 +43,49 @@ class Channel(db.Model):
 
     __tablename__ = "channels"
     id = db.Column(db.Integer, primary_key=True)
-    active = db.Column("is_active", db.Boolean(), nullable=False, server_default="1")
-    name = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+    active = db.Column(
+        "is_active", db.Boolean(), nullable=False, server_default="1", index=True
+    )
+    name = db.Column(db.String(100, collation="NOCASE"), nullable=False, index=True)
     endpoint = db.Column(
         db.String(100, collation="NOCASE"), nullable=False, unique=True
     )
     authkey = db.Column(db.String(100, collation="NOCASE"), nullable=False)
-    type_of_service = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+    type_of_service = db.Column(
+        db.String(100, collation="NOCASE"), nullable=False, index=True
+    )
     last_heartbeat = db.Column(db.DateTime(), nullable=True, server_default=None)
 
 
+class ChannelChange(db.Model):
+    """Entry of the change feed: a channel was registered, changed or removed."""
+
+    __tablename__ = "channel_changes"
+    id = db.Column(db.Integer, primary_key=True)  # version of the channel directory
+    endpoint = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+
+
+class Registration(db.Model):
+    """An asynchronous registration of a channel and the state of its health check.
+
+    A registration is "pending" until a background worker checked the
+    channel, then "active" (the channel was added or updated) or "failed".
+    A pending registration is "superseded" by a newer one of the endpoint.
+    """
+
+    __tablename__ = "channel_registrations"
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    name = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+    endpoint = db.Column(db.String(100, collation="NOCASE"), nullable=False, index=True)
+    authkey = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+    type_of_service = db.Column(db.String(100, collation="NOCASE"), nullable=False)
+    error = db.Column(db.String(200), nullable=True)
+    channel_id = db.Column(db.Integer, nullable=True)
+    created = db.Column(db.DateTime(), nullable=False)
+    updated = db.Column(db.DateTime(), nullable=False)
+
+
 # Class-based application configuration
 class ConfigClass(object):
     """Flask application configuration settings."""
@@ -43,29 +102,107 @@ class ConfigClass(object):
 app = Flask(__name__)
 CORS(app)
 app.config.from_object(__name__ + ".ConfigClass")  # configuration
-app.app_context().push()  # create an app context before initializing db
-db.init_app(app)  # initialize database
-db.create_all()  # create database if necessary
+db.init_app(app)  # initialize database (tables are created by migrate_database)
 
 SERVER_AUTHKEY = "1234567890"
+HEALTH_CHECK_TIMEOUT = (3, 5)  # (connect, read) timeout of a health check in seconds
+HEALTH_CHECK_CONCURRENCY = 16  # parallel health checks in check_channels
+HEARTBEAT_ENABLED = False  # run the heartbeat scheduler inside the hub processes
+HEARTBEAT_LOCK_FILE = None  # elects the one probing process, None: next to the db
+HEARTBEAT_INTERVAL = 60  # seconds between probes of a healthy channel ...
+HEARTBEAT_MAX_INTERVAL = 600  # ... growing up to this while it stays healthy
+HEARTBEAT_RETRY_INTERVAL = 10  # seconds until the first retry of a failing channel ...
+HEARTBEAT_MAX_RETRY_INTERVAL = 900  # ... doubling up to this on every failure
+HEARTBEAT_JITTER = 0.1  # intervals are randomized by +/- this fraction
+HEARTBEAT_TICK = 1  # seconds between checks for due probes
+DIRECTORY_TTL = 5  # seconds a cached channel list is served without revalidation
+DIRECTORY_CACHE_SIZE = 128  # number of cached channel list queries
+CHANGE_FEED_SIZE = 1000  # changes kept in the feed, older cursors get a snapshot
+CHANGE_FEED_MAX_WAIT = 25  # max seconds a GET /channels/changes?wait=.. is held
+CHANGE_FEED_POLL_INTERVAL = 1  # seconds between checks for changes of other processes
+FEED = Broadcaster()  # wakes up change feed requests waiting in this process
+REGISTRATION_WORKERS = 8  # background health checks of asynchronous registrations
+REGISTRATION_TIMEOUT = (3, 5)  # (connect, read) timeout of those health checks
+REGISTRATION_MAX_BATCH = 1000  # channels per bulk registration
+REGISTRATION_RETENTION = 24 * 3600  # seconds a finished registration can be queried
+REGISTRATION_EXECUTOR = None
+HEALTH_CHECK_SECONDS = metrics.Histogram(
+    "hub_health_check_duration_seconds", "Duration of channel health checks."
+)
+HEALTH_CHECKS = metrics.Counter(
+    "hub_health_checks_total", "Channel health checks by result.", ("healthy",)
+)
+metrics.instrument(
+    app,
+    "hub",
+    authorize=lambda r: r.headers.get("Authorization") == "authkey " + SERVER_AUTHKEY,
+)
 
 
-def health_check(endpoint, authkey):
-    """Check the health of a channel by making a GET request to its health endpoint.
+def commit_changes(endpoints) -> None:
+    """Commit the session, recording changed channels in the change feed.
+
+    Args:
+        endpoints (Iterable): endpoints of the channels that were added,
+            changed (name, authkey, type of service or health) or removed
+
+    """
+    endpoints = list(endpoints)
+    for endpoint in endpoints:
+        db.session.add(ChannelChange(endpoint=endpoint))
+    if endpoints:
+        db.session.flush()
+        latest = db.session.query(db.func.max(ChannelChange.id)).scalar()
+        ChannelChange.query.filter(
+            ChannelChange.id <= latest - CHANGE_FEED_SIZE
+        ).delete()
+    db.session.commit()
+    if endpoints:
+        DIRECTORY.invalidate()
+        FEED.publish()
+
+
+def probe_channel(endpoint, authkey, expected_name, timeout=None):
+    """Request the health endpoint of a channel without touching the database.
 
     Args:
         endpoint (str): The URL endpoint of the channel.
         authkey (str): The authorization key for the channel.
+        expected_name (str): The name the channel was registered with.
+        timeout (tuple): (connect, read) timeout in seconds, defaults to
+            HEALTH_CHECK_TIMEOUT.
 
     Returns:
-        bool: True if the channel is healthy, False otherwise.
+        bool: True if the channel answered with the expected name, False otherwise.
+
+    """
+    with HEALTH_CHECK_SECONDS.time():
+        healthy = request_health(endpoint, authkey, expected_name, timeout)
+    HEALTH_CHECKS.inc(str(healthy).lower())
+    return healthy
+
+
+def request_health(endpoint, authkey, expected_name, timeout=None):
+    """Request the health endpoint of a channel and check its answer.
+
+    Args:
+        endpoint (str): The URL endpoint of the channel.
+        authkey (str): The authorization key for the channel.
+        expected_name (str): The name the channel was registered with.
+        timeout (tuple): (connect, read) timeout in seconds.
+
+    Returns:
+        bool: True if the channel answered with the expected name, False otherwise.
 
     """
     # make GET request to URL
     # add authkey to request header
     try:
-        response = requests.get(
-            endpoint + "/health", headers={"Authorization": "authkey " + authkey}
+        response = http_client.get_probe_client().request(
+            "GET",
+            endpoint + "/health",
+            headers={"Authorization": "authkey " + authkey},
+            timeout=timeout or HEALTH_CHECK_TIMEOUT,
         )
     except requests.exceptions.RequestException as e:
         print(f"Error: {e}")
@@ -73,16 +210,33 @@ def health_check(endpoint, authkey):
     if response.status_code != 200:
         return False
     # check if response is JSON with {"name": <channel_name>}
-    if "name" not in response.json():
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    if not isinstance(data, dict) or "name" not in data:
         return False
     # check if channel name is as expected
     # (channels can't change their name, must be re-registered)
+    return data["name"] == expected_name
+
+
+def health_check(endpoint, authkey):
+    """Check the health of a channel by making a GET request to its health endpoint.
+
+    Args:
+        endpoint (str): The URL endpoint of the channel.
+        authkey (str): The authorization key for the channel.
+
+    Returns:
+        bool: True if the channel is healthy, False otherwise.
+
+    """
     channel = Channel.query.filter_by(endpoint=endpoint).first()
     if not channel:
         print(f"Channel {endpoint} not found in database")
         return False
-    expected_name = channel.name
-    if response.json()["name"] != expected_name:
+    if not probe_channel(endpoint, authkey, channel.name):
         return False
 
     # everything is OK, set last_heartbeat to now
@@ -91,23 +245,306 @@ def health_check(endpoint, authkey):
     return True
 
 
+def check_all_channels(concurrency=None, timeout=None):
+    """Check the health of all channels in parallel and store the results.
+
+    The health checks run in a thread pool of at most ``concurrency``
+    threads. All resulting updates are committed in a single transaction.
+
+    Args:
+        concurrency (int): maximum number of parallel health checks,
+            defaults to HEALTH_CHECK_CONCURRENCY.
+        timeout (tuple): (connect, read) timeout of each check in seconds,
+            defaults to HEALTH_CHECK_TIMEOUT.
+
+    Returns:
+        dict: Channel endpoints mapped to their health (True if healthy).
+
+    """
+    channels = Channel.query.all()
+    if not channels:
+        return {}
+    # read the attributes here, the worker threads must not touch the session
+    targets = [(c.endpoint, c.authkey, c.name) for c in channels]
+    workers = min(concurrency or HEALTH_CHECK_CONCURRENCY, len(channels))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda t: probe_channel(*t, timeout), targets))
+    now = datetime.datetime.now()
+    changed = []
+    for channel, healthy in zip(channels, results):
+        if channel.active != healthy:
+            changed.append(channel.endpoint)
+        channel.active = healthy
+        if healthy:
+            channel.last_heartbeat = now
+    commit_changes(changed)
+    return {channel.endpoint: healthy for channel, healthy in zip(channels, results)}
+
+
 # cli command to check health of all channels
 @app.cli.command("check_channels")
-def check_channels():
+@click.option(
+    "--concurrency",
+    default=HEALTH_CHECK_CONCURRENCY,
+    show_default=True,
+    help="Maximum number of parallel health checks.",
+)
+def check_channels(concurrency):
     """Command line interface command to check the health of all channels.
 
     Checks all channels in the database and updates their status based on health checks.
+    Registrations left pending (e.g. by a restarted hub process) are checked too.
     """
-    channels = Channel.query.all()
-    for channel in channels:
-        if not health_check(channel.endpoint, channel.authkey):
-            print(f"Channel {channel.endpoint} is not healthy")
-            channel.active = False
-            db.session.commit()
+    pending = verify_pending_registrations()
+    if pending:
+        print(f"Checked {pending} pending registrations")
+    for endpoint, healthy in check_all_channels(concurrency).items():
+        if healthy:
+            print(f"Channel {endpoint} is healthy")
         else:
-            print(f"Channel {channel.endpoint} is healthy")
-            channel.active = True
-            db.session.commit()
+            print(f"Channel {endpoint} is not healthy")
+
+
+class HeartbeatScheduler(object):
+    """Probe every channel in the background on its own cadence.
+
+    A channel that stays healthy is probed less and less often, from
+    HEARTBEAT_INTERVAL up to HEARTBEAT_MAX_INTERVAL. A failing channel is
+    retried with exponential backoff, from HEARTBEAT_RETRY_INTERVAL up to
+    HEARTBEAT_MAX_RETRY_INTERVAL. All intervals are jittered, and channels
+    seen for the first time are spread evenly over one interval (based on
+    their ``last_heartbeat``), so probes don't come in bursts.
+
+    Every hub process (WSGI worker) may run a scheduler, but only the one
+    holding the heartbeat lock probes channels (see ``elect``). The others
+    keep trying to take the lock and take over when its holder exits.
+
+    ``now`` and ``rand`` can be replaced for tests; ``run_pending`` performs
+    a single scheduling step without starting the background thread.
+    """
+
+    def __init__(self, app, now=None, rand=None):
+        """Create a scheduler for the channels of the hub application.
+
+        Args:
+            app (flask.Flask): the hub application
+            now (callable): returns the current datetime.datetime
+            rand (callable): returns a random float in [0, 1)
+
+        """
+        self.app = app
+        self.now = now or datetime.datetime.now
+        self.rand = rand or random.random
+        self.due = {}  # endpoint -> datetime of the next probe
+        self.successes = {}  # endpoint -> consecutive successful probes
+        self.failures = {}  # endpoint -> consecutive failed probes
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock_fd = None  # open heartbeat lock file while this process holds it
+
+    def elect(self) -> bool:
+        """Try to become the process probing the channels.
+
+        The process holding an exclusive lock on the heartbeat lock file
+        (HEARTBEAT_LOCK_FILE) runs the heartbeat; it keeps the lock until it
+        stops or exits. Without fcntl (Windows) every process runs it.
+
+        Returns:
+            bool: True if this process runs the heartbeat
+
+        """
+        if self.lock_fd is not None or fcntl is None:
+            return True
+        fd = os.open(heartbeat_lock_file(self.app), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    def jitter(self, seconds: float) -> datetime.timedelta:
+        """Randomize an interval by +/- HEARTBEAT_JITTER.
+
+        Args:
+            seconds (float): the interval
+
+        Returns:
+            datetime.timedelta: the jittered interval
+
+        """
+        factor = 1 + HEARTBEAT_JITTER * (2 * self.rand() - 1)
+        return datetime.timedelta(seconds=seconds * factor)
+
+    def next_interval(self, endpoint: str) -> float:
+        """Return the seconds until the next probe of a channel.
+
+        Args:
+            endpoint (str): endpoint of the channel
+
+        Returns:
+            float: interval based on its consecutive successes or failures
+
+        """
+        failures = self.failures.get(endpoint, 0)
+        if failures:
+            return min(
+                HEARTBEAT_RETRY_INTERVAL * 2 ** (failures - 1),
+                HEARTBEAT_MAX_RETRY_INTERVAL,
+            )
+        successes = self.successes.get(endpoint, 0)
+        return min(
+            HEARTBEAT_INTERVAL * 2 ** max(successes - 1, 0), HEARTBEAT_MAX_INTERVAL
+        )
+
+    def sync(self, channels: list, now: datetime.datetime) -> None:
+        """Schedule new channels and forget removed ones.
+
+        Args:
+            channels (list): all channels of the database
+            now (datetime.datetime): current time
+
+        """
+        endpoints = {c.endpoint for c in channels}
+        for endpoint in list(self.due):
+            if endpoint not in endpoints:
+                del self.due[endpoint]
+                self.successes.pop(endpoint, None)
+                self.failures.pop(endpoint, None)
+        new = [c for c in channels if c.endpoint not in self.due]
+        interval = datetime.timedelta(seconds=HEARTBEAT_INTERVAL)
+        for i, channel in enumerate(new):
+            slot = now + interval * i / len(new)
+            if channel.last_heartbeat and channel.last_heartbeat + interval > slot:
+                slot = channel.last_heartbeat + interval
+            self.due[channel.endpoint] = slot
+
+    def run_pending(self) -> int:
+        """Probe all channels that are due and store the results.
+
+        Returns:
+            int: number of probed channels
+
+        """
+        with self.app.app_context():
+            now = self.now()
+            channels = Channel.query.all()
+            self.sync(channels, now)
+            due = [c for c in channels if self.due[c.endpoint] <= now]
+            if not due:
+                return 0
+            targets = [(c.endpoint, c.authkey, c.name) for c in due]
+            workers = min(HEALTH_CHECK_CONCURRENCY, len(due))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(lambda t: probe_channel(*t), targets))
+            now = self.now()
+            changed = []
+            for channel, healthy in zip(due, results):
+                endpoint = channel.endpoint
+                if healthy:
+                    self.successes[endpoint] = self.successes.get(endpoint, 0) + 1
+                    self.failures.pop(endpoint, None)
+                    channel.last_heartbeat = now
+                else:
+                    self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+                    self.successes.pop(endpoint, None)
+                if channel.active != healthy:
+                    changed.append(endpoint)
+                channel.active = healthy
+                self.due[endpoint] = now + self.jitter(self.next_interval(endpoint))
+            commit_changes(changed)
+            return len(due)
+
+    def run(self) -> None:
+        """Run scheduling steps until the scheduler is stopped.
+
+        Steps only run while this process is elected (see ``elect``).
+        """
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    if self.elect():
+                        self.run_pending()
+                except Exception as e:
+                    print(f"Heartbeat error: {e}")
+                self.stop_event.wait(HEARTBEAT_TICK)
+        finally:
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)  # releases the lock
+                self.lock_fd = None
+
+    def start(self) -> None:
+        """Start the scheduler in a daemon thread (if not already running)."""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="heartbeat", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None) -> None:
+        """Stop the scheduler and wait for the running step to finish.
+
+        Args:
+            timeout (float): maximum seconds to wait for the thread
+
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+
+def heartbeat_lock_file(app) -> str:
+    """Return the path of the lock file electing the heartbeat process.
+
+    Args:
+        app (flask.Flask): the hub application
+
+    Returns:
+        str: HEARTBEAT_LOCK_FILE, by default next to the SQLite database (or
+            in the instance folder)
+
+    """
+    if HEARTBEAT_LOCK_FILE:
+        return HEARTBEAT_LOCK_FILE
+    with app.app_context():
+        url = db.engine.url
+    if (
+        url.get_backend_name() == "sqlite"
+        and url.database
+        and url.database != ":memory:"
+    ):
+        return url.database + ".heartbeat.lock"
+    os.makedirs(app.instance_path, exist_ok=True)
+    return os.path.join(app.instance_path, "heartbeat.lock")
+
+
+HEARTBEAT = HeartbeatScheduler(app)
+
+
+def start_heartbeat():
+    """Start the background heartbeat scheduler of the hub."""
+    HEARTBEAT.start()
+    atexit.register(HEARTBEAT.stop, HEARTBEAT_TICK)
+
+
+def stop_heartbeat():
+    """Stop the background heartbeat scheduler of the hub."""
+    HEARTBEAT.stop()
+
+
+@app.cli.command("heartbeat")
+def heartbeat_command():
+    """Run the heartbeat scheduler in the foreground until interrupted."""
+    try:
+        HEARTBEAT.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if HEARTBEAT_ENABLED:
+    start_heartbeat()
 
 
 # The Home page is accessible to anyone
@@ -125,18 +562,40 @@ def home_page():
     return render_template("home.html")
 
 
+@app.route("/stats/http", methods=["GET"])
+def http_stats():
+    """Return statistics of the outbound HTTP connection pools.
+
+    Returns:
+        Any: JSON response with request counters, circuit states and
+             connection reuse per host.
+
+    """
+    if request.headers.get("Authorization") != "authkey " + SERVER_AUTHKEY:
+        return "Invalid authorization header", 400
+    return jsonify(http_client.stats()), 200
+
+
 # Flask REST route for POST to /channels
 @app.route("/channels", methods=["POST"])
 def create_channel():
     """Create a channel via a POST endpoint.
 
+    By default the health of the channel is checked before answering. With
+    ``?async=1`` the registration is only recorded and answered with 202
+    and the URL of its status (also in the Location header), a background
+    worker checks the channel and adds it if it is healthy, see
+    register_async. A JSON array of up to REGISTRATION_MAX_BATCH channels is
+    always registered asynchronously, the response lists the result of
+    every channel.
+
     Returns:
         Any: JSON response indicating creation status and channel ID.
 
     """
     global SERVER_AUTHKEY
 
-    record = json.loads(request.data)
+    record = serialization.loads(request.data)
 
     # check if authorization header is present
     if "Authorization" not in request.headers:
@@ -146,14 +605,16 @@ def create_channel():
         return "Invalid authorization header ({})".format(
             request.headers["Authorization"]
         ), 400
-    if "name" not in record:
-        return "Record has no name", 400
-    if "endpoint" not in record:
-        return "Record has no endpoint", 400
-    if "authkey" not in record:
-        return "Record has no authkey", 400
-    if "type_of_service" not in record:
-        return "Record has no type of service representation", 400
+    if isinstance(record, list):
+        if len(record) > REGISTRATION_MAX_BATCH:
+            return "Too many channels", 413
+        return jsonify(results=register_async(record)), 202
+    error = check_record(record)
+    if error:
+        return error, 400
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        result = register_async([record])[0]
+        return jsonify(result), 202, {"Location": result["status_url"]}
 
     update_channel = Channel.query.filter_by(endpoint=record["endpoint"]).first()
     print("update_channel: ", update_channel)
@@ -162,7 +623,7 @@ def create_channel():
         update_channel.authkey = record["authkey"]
         update_channel.type_of_service = record["type_of_service"]
         update_channel.active = False
-        db.session.commit()
+        commit_changes([update_channel.endpoint])
         if not health_check(record["endpoint"], record["authkey"]):
             return "Channel is not healthy", 400
         return jsonify(created=False, id=update_channel.id), 200
@@ -176,38 +637,492 @@ def create_channel():
             active=True,
         )
         db.session.add(channel)
-        db.session.commit()
+        commit_changes([channel.endpoint])
         if not health_check(record["endpoint"], record["authkey"]):
             # delete channel from database
             db.session.delete(channel)
-            db.session.commit()
+            commit_changes([channel.endpoint])
             return "Channel is not healthy", 400
 
         return jsonify(created=True, id=channel.id), 200
 
 
+def check_record(record) -> str:
+    """Check that a posted channel record has all required fields.
+
+    Args:
+        record (dict): the posted record
+
+    Returns:
+        str: the error, None if the record is valid
+
+    """
+    if not isinstance(record, dict):
+        return "Record is no object"
+    if "name" not in record:
+        return "Record has no name"
+    if "endpoint" not in record:
+        return "Record has no endpoint"
+    if "authkey" not in record:
+        return "Record has no authkey"
+    if "type_of_service" not in record:
+        return "Record has no type of service representation"
+    return None
+
+
+def register_async(records: list) -> list:
+    """Record registrations as pending and queue their health checks.
+
+    Pending registrations of the same endpoints are superseded, finished
+    registrations older than REGISTRATION_RETENTION are removed.
+
+    Args:
+        records (list): the posted channel records
+
+    Returns:
+        list: the result of every record, the ``id``, ``status`` and
+            ``status_url`` of its registration or an ``error``
+
+    """
+    now = datetime.datetime.now()
+    results = []
+    registrations = []
+    for record in records:
+        error = check_record(record)
+        if error:
+            results.append({"status": "error", "error": error})
+            continue
+        Registration.query.filter_by(
+            endpoint=record["endpoint"], status="pending"
+        ).update({"status": "superseded", "updated": now})
+        registration = Registration(
+            status="pending",
+            name=record["name"],
+            endpoint=record["endpoint"],
+            authkey=record["authkey"],
+            type_of_service=record["type_of_service"],
+            created=now,
+            updated=now,
+        )
+        db.session.add(registration)
+        db.session.flush()  # assigns the id
+        results.append(registration_details(registration))
+        registrations.append(registration.id)
+    Registration.query.filter(
+        Registration.status != "pending",
+        Registration.updated < now - datetime.timedelta(seconds=REGISTRATION_RETENTION),
+    ).delete()
+    db.session.commit()
+    executor = get_registration_executor()
+    for id in registrations:
+        executor.submit(verify_registration, id)
+    return results
+
+
+def get_registration_executor() -> ThreadPoolExecutor:
+    """Return the thread pool checking registrations, created on first use.
+
+    Returns:
+        ThreadPoolExecutor: pool of REGISTRATION_WORKERS threads
+
+    """
+    global REGISTRATION_EXECUTOR
+    if REGISTRATION_EXECUTOR is None:
+        REGISTRATION_EXECUTOR = ThreadPoolExecutor(
+            max_workers=REGISTRATION_WORKERS, thread_name_prefix="registration"
+        )
+    return REGISTRATION_EXECUTOR
+
+
+def verify_registration(id: int) -> None:
+    """Check the health of a pending registration and finish it.
+
+    A healthy channel is added (or updated, if its endpoint is registered
+    already) and marked active. Otherwise the registration failed and an
+    existing channel is left as it is. No transaction is open during the
+    health check.
+
+    Args:
+        id (int): id of the registration
+
+    """
+    with app.app_context():
+        try:
+            registration = db.session.get(Registration, id)
+            if registration is None or registration.status != "pending":
+                return
+            target = (registration.endpoint, registration.authkey, registration.name)
+            db.session.rollback()  # end the read transaction before the check
+            healthy = probe_channel(*target, REGISTRATION_TIMEOUT)
+            registration = db.session.get(Registration, id)
+            if registration is None or registration.status != "pending":
+                return  # superseded while it was checked
+            now = datetime.datetime.now()
+            registration.updated = now
+            if not healthy:
+                registration.status = "failed"
+                registration.error = "Channel is not healthy"
+                db.session.commit()
+                return
+            channel = Channel.query.filter_by(endpoint=registration.endpoint).first()
+            if channel is None:
+                channel = Channel(endpoint=registration.endpoint)
+                db.session.add(channel)
+            channel.name = registration.name
+            channel.authkey = registration.authkey
+            channel.type_of_service = registration.type_of_service
+            channel.active = True
+            channel.last_heartbeat = now
+            db.session.flush()  # assigns the id of a new channel
+            registration.status = "active"
+            registration.channel_id = channel.id
+            commit_changes([channel.endpoint])
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error verifying registration {id}: {e}")
+
+
+def verify_pending_registrations() -> int:
+    """Check the health of all pending registrations (e.g. after a restart).
+
+    Returns:
+        int: number of checked registrations
+
+    """
+    ids = [
+        id for (id,) in db.session.query(Registration.id).filter_by(status="pending")
+    ]
+    db.session.rollback()
+    if ids:
+        with ThreadPoolExecutor(
+            max_workers=min(REGISTRATION_WORKERS, len(ids))
+        ) as executor:
+            list(executor.map(verify_registration, ids))
+    return len(ids)
+
+
+def registration_details(registration: Registration) -> dict:
+    """Return the state of a registration.
+
+    Args:
+        registration (Registration): the registration
+
+    Returns:
+        dict: id, endpoint, status, URL of the status, error and the id of
+            the channel once it is active
+
+    """
+    return {
+        "id": registration.id,
+        "endpoint": registration.endpoint,
+        "status": registration.status,
+        "status_url": url_for("get_registration", id=registration.id, _external=True),
+        "error": registration.error,
+        "channel_id": registration.channel_id,
+    }
+
+
+@app.route("/channels/registrations/<int:id>", methods=["GET"])
+def get_registration(id):
+    """GET route of the status of an asynchronous registration.
+
+    Args:
+        id (int): id of the registration
+
+    Returns:
+        Any: JSON response with the state of the registration.
+
+    """
+    if request.headers.get("Authorization") != "authkey " + SERVER_AUTHKEY:
+        return "Invalid authorization header", 400
+    registration = db.session.get(Registration, id)
+    if registration is None:
+        return "Registration not found", 404
+    return jsonify(registration_details(registration)), 200
+
+
+ChannelPage = namedtuple("ChannelPage", ["body", "etag", "last_modified", "built"])
+
+
+class ChannelDirectory(object):
+    """In-memory cache of rendered channel lists.
+
+    Every distinct query of GET /channels is rendered once and served from
+    memory until the directory is invalidated (on registrations and health
+    state changes in this process) or DIRECTORY_TTL expired, which bounds
+    the staleness caused by changes in other processes. A rebuilt page that
+    didn't change keeps its body, including the compressed variants.
+    """
+
+    def __init__(self, ttl=None, size=None):
+        """Create an empty directory.
+
+        Args:
+            ttl (float): seconds until a cached list is rebuilt
+            size (int): maximum number of cached lists
+
+        """
+        self.ttl = DIRECTORY_TTL if ttl is None else ttl
+        self.size = size or DIRECTORY_CACHE_SIZE
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """Mark all cached lists stale, they are rebuilt on their next request."""
+        stale = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        with self.lock:
+            for key, page in self.pages.items():
+                # keep the page: its ETag and Last-Modified are compared
+                self.pages[key] = page._replace(built=stale)
+
+    def get(self, key, build) -> ChannelPage:
+        """Return the cached page for a query, building it if necessary.
+
+        Args:
+            key (tuple): the query parameters
+            build (callable): returns the JSON body of the page
+
+        Returns:
+            ChannelPage: the rendered page, its body a compression.Body
+
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            page = self.pages.get(key)
+            if page and (now - page.built).total_seconds() < self.ttl:
+                self.pages.move_to_end(key)
+                return page
+        data = build().encode()
+        etag = hashlib.sha1(data).hexdigest()
+        if page and page.etag == etag:
+            # an unchanged list keeps its modification time and compressed body
+            page = page._replace(built=now)
+        else:
+            last_modified = now.replace(microsecond=0)
+            if page and last_modified <= page.last_modified:
+                # HTTP dates have whole seconds, a list changed again within
+                # the second must still be newer for If-Modified-Since
+                last_modified = page.last_modified + datetime.timedelta(seconds=1)
+            page = ChannelPage(compression.Body(data), etag, last_modified, now)
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        return page
+
+
+DIRECTORY = ChannelDirectory()
+
+
+def build_channel_list(active, type_of_service, name, cursor, limit) -> str:
+    """Query the channels matching a GET /channels request.
+
+    Args:
+        active (bool): only active (True) or inactive (False) channels
+        type_of_service (str): only channels of this type of service
+        name (str): only channels whose name starts with this prefix
+        cursor (int): only channels with an id greater than this
+        limit (int): maximum number of channels
+
+    Returns:
+        str: JSON encoded list of channel details
+
+    """
+    query = Channel.query
+    if active is not None:
+        query = query.filter(Channel.active == active)
+    if type_of_service:
+        query = query.filter(Channel.type_of_service == type_of_service)
+    if name:
+        query = query.filter(Channel.name.startswith(name, autoescape=True))
+    if cursor is not None:
+        query = query.filter(Channel.id > cursor)
+    query = query.order_by(Channel.id)
+    if limit is not None:
+        query = query.limit(limit + 1)  # one more to know if there is a next page
+    channels = query.all()
+    result = {}
+    if limit is not None:
+        result["next_cursor"] = (
+            channels[limit - 1].id if len(channels) > limit else None
+        )
+        channels = channels[:limit]
+    result["channels"] = [channel_details(c) for c in channels]
+    return app.json.dumps(result)
+
+
+def channel_details(channel: Channel) -> dict:
+    """Return the public details of a channel.
+
+    Args:
+        channel (Channel): the channel
+
+    Returns:
+        dict: name, endpoint, authkey and type of service
+
+    """
+    return {
+        "name": channel.name,
+        "endpoint": channel.endpoint,
+        "authkey": channel.authkey,
+        "type_of_service": channel.type_of_service,
+    }
+
+
 @app.route("/channels", methods=["GET"])
 def get_channels():
     """GET route to retrieve all channels.
 
+    Supported query parameters are ``active`` (1 or 0), ``type_of_service``,
+    ``name`` (prefix search) and cursor pagination with ``limit`` and
+    ``cursor`` (the ``next_cursor`` of the previous page). The list is served
+    from DIRECTORY with ETag and Last-Modified, so an unchanged list costs a
+    304, compressed with gzip or brotli if the client accepts it.
+
     Returns:
         Any: JSON response containing a list of channel details.
 
     """
-    channels = Channel.query.all()
-    return jsonify(
-        channels=[
-            {
-                "name": c.name,
-                "endpoint": c.endpoint,
-                "authkey": c.authkey,
-                "type_of_service": c.type_of_service,
-            }
-            for c in channels
+    active = request.args.get("active", None)
+    if active is not None:
+        active = active.lower() in ("1", "true", "yes")
+    type_of_service = request.args.get("type_of_service", None)
+    name = request.args.get("name", None)
+    cursor = request.args.get("cursor", None, type=int)
+    limit = request.args.get("limit", None, type=int)
+    if limit is not None and limit < 1:
+        return "Limit must be positive", 400
+    key = (active, type_of_service, name, cursor, limit)
+    page = DIRECTORY.get(key, lambda: build_channel_list(*key))
+    response = compression.make_response(app, request, page.body, page.etag)
+    response.last_modified = page.last_modified
+    return response.make_conditional(request)
+
+
+def build_change_feed(since) -> dict:
+    """Return the changes of the channel directory after a version.
+
+    Args:
+        since (int): the last version the caller has seen, None for none
+
+    Returns:
+        dict: the current ``version`` and the ``changes`` since ``since``, or
+            a snapshot of all ``channels`` with ``reset`` set if the caller
+            has no version yet or its changes were dropped from the feed
+
+    """
+    latest, oldest = db.session.query(
+        db.func.max(ChannelChange.id), db.func.min(ChannelChange.id)
+    ).one()
+    latest = latest or 0
+    result = {"version": latest}
+    if since is None or since > latest or since < (oldest or 1) - 1:
+        result["reset"] = True
+        result["channels"] = [
+            dict(channel_details(c), active=c.active)
+            for c in Channel.query.order_by(Channel.id)
+        ]
+        return result
+    endpoints = OrderedDict.fromkeys(
+        endpoint
+        for (endpoint,) in db.session.query(ChannelChange.endpoint)
+        .filter(ChannelChange.id > since)
+        .order_by(ChannelChange.id)
+    )
+    channels = {
+        c.endpoint: c
+        for c in Channel.query.filter(Channel.endpoint.in_(list(endpoints)))
+    }
+    result["changes"] = [
+        dict(channel_details(channels[e]), active=channels[e].active)
+        if e in channels
+        else {"endpoint": e, "deleted": True}
+        for e in endpoints
+    ]
+    return result
+
+
+@app.route("/channels/changes", methods=["GET"])
+def get_channel_changes():
+    """GET route of the change feed of the channel directory.
+
+    Clients keep a copy of the directory and pass the ``version`` of their
+    last response as ``since`` to receive only the channels that changed
+    (removed channels are marked ``deleted``). With ``wait`` (seconds, at
+    most CHANGE_FEED_MAX_WAIT) the request is held until there are changes
+    (long-poll), so clients learn about them immediately.
+
+    Returns:
+        Any: JSON response with the version and the changes or a snapshot.
+
+    """
+    since = request.args.get("since", None, type=int)
+    wait = max(min(request.args.get("wait", 0, type=float), CHANGE_FEED_MAX_WAIT), 0)
+    deadline = time.monotonic() + wait
+    while True:
+        version = FEED.version
+        feed = build_change_feed(since)
+        db.session.rollback()  # end the read transaction before waiting
+        remaining = deadline - time.monotonic()
+        if feed.get("reset") or feed["changes"] or remaining <= 0:
+            return jsonify(feed)
+        FEED.wait(version, min(remaining, CHANGE_FEED_POLL_INTERVAL))
+
+
+def migrate_database() -> None:
+    """Create missing tables and indexes (needs an app context).
+
+    Run once per deployment (and after updates adding tables or indexes)
+    with ``flask --app hub.py migrate``, not by every worker at import.
+    """
+    db.create_all()
+    for table in db.metadata.sorted_tables:  # indexes added to existing tables
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Command line interface command to create or update the database schema."""
+    migrate_database()
+    print(f"Database {db.engine.url} is up to date")
+
+
+def warm_up() -> None:
+    """Prepare a new worker for traffic (called by hub.wsgi before serving).
+
+    Connects to the database, builds the unfiltered channel list in DIRECTORY,
+    compiles the templates and creates the HTTP clients, so the first
+    requests don't pay for it.
+
+    Raises:
+        RuntimeError: if the database has tables missing (run migrate)
+
+    """
+    http_client.get_client()
+    http_client.get_probe_client()
+    app.jinja_env.get_template("home.html")
+    with app.app_context():
+        inspector = db.inspect(db.engine)
+        missing = [
+            table.name
+            for table in db.metadata.sorted_tables
+            if not inspector.has_table(table.name)
         ]
-    ), 200
+        if missing:
+            raise RuntimeError(
+                "Database tables {} are missing, run 'flask --app hub.py migrate'".format(
+                    ", ".join(missing)
+                )
+            )
+        key = (None, None, None, None, None)
+        DIRECTORY.get(key, lambda: build_channel_list(*key))
 
 
 # Start development web server
 if __name__ == "__main__":
+    with app.app_context():
+        migrate_database()
+    warm_up()
     app.run(port=5555, debug=True)
@@ -0,0 +1,1124 @@
+"""message_store.py - pluggable storage backends for channel messages."""
+
+import bisect
+import heapq
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, only lock within the process
+    fcntl = None
+
+try:  # imported as hub_channel.message_store
+    from . import serialization
+except ImportError:
+    import serialization
+
+
+class MessageStore(object):
+    """Base class for channel message stores.
+
+    A store keeps the messages of one channel. Messages older than
+    ``max_age`` seconds expire, except for messages with ``extra == "INIT"``.
+
+    Every stored message carries a monotonic integer ``id``, which clients use
+    as cursor to fetch only the messages they haven't seen yet.
+
+    Writes are safe across threads and processes: subclasses hold a
+    FileLock while writing, and whole files are only replaced atomically.
+    Concurrent calls of ``append`` are coalesced (group commit): while one
+    thread writes, the messages of the others are queued and written
+    together by the next writer in a single write.
+    """
+
+    def __init__(self, max_age=None):
+        """Create a store.
+
+        Args:
+            max_age (float): seconds until a message expires, None for never
+
+        """
+        self.max_age = max_age
+        self.commit_condition = threading.Condition()
+        self.commit_queue = []  # CommitEntry objects waiting to be written
+        self.committing = False
+
+    def expire(self, messages: list) -> list:
+        """Filter out expired messages.
+
+        Args:
+            messages (list): messages to filter
+
+        Returns:
+            list: the messages that are not expired
+
+        """
+        return filter_old_messages(messages, self.max_age)
+
+    def read(self) -> list:
+        """Return all messages that are not expired.
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        return self.expire(list(self.iter_messages()))
+
+    def select(self, since=None, limit=None) -> list:
+        """Return non-expired messages, optionally after a cursor.
+
+        Args:
+            since (int): only return messages with an id greater than this
+            limit (int): maximum number of messages; the first ones after
+                ``since``, or the latest ones if no cursor is given
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        messages = self.read()
+        if since is not None:
+            messages = [m for m in messages if m.get("id", 0) > since]
+        return apply_limit(messages, since, limit)
+
+    def last_id(self) -> int:
+        """Return the id of the newest stored message.
+
+        Returns:
+            int: the newest id, 0 if the store is empty
+
+        """
+        return max((m.get("id", 0) for m in self.iter_messages()), default=0)
+
+    def iter_messages(self):
+        """Iterate over all stored messages, including expired ones.
+
+        Yields:
+            dict: stored messages in insertion order
+
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """Return a cheap token that changes whenever the stored messages change.
+
+        The token also changes on writes of other processes, so results read
+        from the store can be cached until it changes (see ``expires`` for
+        messages expiring in the meantime).
+
+        Returns:
+            Hashable: the token, None if the store can't provide one
+
+        """
+        return None
+
+    def expires(self, messages: list):
+        """Return when the first of the given messages expires.
+
+        Stores that know their next expiry without parsing the messages
+        return that instead, which may be earlier than needed for a selection
+        but never later.
+
+        Args:
+            messages (list): messages read from the store
+
+        Returns:
+            float: seconds since the epoch, None if none of them expires
+
+        """
+        if self.max_age is None:
+            return None
+        return min(
+            (
+                message_time(message) + self.max_age
+                for message in messages
+                if message.get("extra") != "INIT"
+            ),
+            default=None,
+        )
+
+    def append(self, messages: list) -> None:
+        """Add new messages to the store and wait until they are written.
+
+        Messages appended concurrently by other threads are written together.
+
+        Args:
+            messages (list): messages to add, ids are assigned in place
+
+        """
+        if not messages:
+            return
+        entry = CommitEntry(messages)
+        with self.commit_condition:
+            self.commit_queue.append(entry)
+            while self.committing and not entry.done:
+                self.commit_condition.wait()
+            if not entry.done:
+                # become the writer of everything queued so far
+                self.committing = True
+                batch, self.commit_queue = self.commit_queue, []
+        if entry.done:
+            if entry.error:
+                raise entry.error
+            return
+        error = None
+        try:
+            self.write_messages([m for e in batch for m in e.messages])
+        except Exception as e:
+            error = e
+        with self.commit_condition:
+            for e in batch:
+                e.done, e.error = True, error
+            self.committing = False
+            self.commit_condition.notify_all()
+        if error:
+            raise error
+
+    def write_messages(self, messages: list) -> None:
+        """Write new messages to the underlying storage.
+
+        Args:
+            messages (list): messages to add, ids are assigned in place
+
+        """
+        raise NotImplementedError
+
+    def replace(self, messages: list) -> None:
+        """Replace the content of the store with the given messages.
+
+        Args:
+            messages (list): new content of the store
+
+        """
+        raise NotImplementedError
+
+    def compact(self) -> None:
+        """Drop expired messages from the underlying storage."""
+        self.replace(self.read())
+
+    def import_json(self, path: str) -> int:
+        """Import messages from a JSON file (the legacy messages.json format).
+
+        Args:
+            path (str): path of the JSON file
+
+        Returns:
+            int: number of imported messages
+
+        """
+        messages = read_json_file(path)
+        self.replace(messages)
+        return len(messages)
+
+    def export_json(self, path: str) -> int:
+        """Export all non-expired messages to a JSON file.
+
+        Args:
+            path (str): path of the JSON file
+
+        Returns:
+            int: number of exported messages
+
+        """
+        messages = self.read()
+        write_json_file(path, messages)
+        return len(messages)
+
+
+class JsonFileStore(MessageStore):
+    """Store keeping all messages in a single JSON list.
+
+    This is the original storage format: every write rewrites the whole file.
+    """
+
+    def __init__(self, path: str, max_age=None):
+        """Create a JSON file store.
+
+        Args:
+            path (str): path of the JSON file
+            max_age (float): seconds until a message expires, None for never
+
+        """
+        super().__init__(max_age)
+        self.path = path
+        self.lock = threading.RLock()
+        self.file_lock = FileLock(path + ".lock")
+
+    def iter_messages(self):
+        """Iterate over all messages in the JSON file.
+
+        Yields:
+            dict: stored messages in insertion order
+
+        """
+        yield from read_json_file(self.path)
+
+    def version(self):
+        """Return the inode, modification time and size of the JSON file.
+
+        The file is replaced atomically on every write, so its inode changes.
+
+        Returns:
+            tuple: the file status, None if there is no file
+
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def write_messages(self, messages: list) -> None:
+        """Add new messages by rewriting the whole file.
+
+        Args:
+            messages (list): messages to add, ids are assigned in place
+
+        """
+        with self.lock, self.file_lock:
+            stored = self.read()
+            last_id = max((m.get("id", 0) for m in stored), default=0)
+            assign_ids(messages, last_id)
+            write_json_file(self.path, self.expire(stored + list(messages)))
+
+    def replace(self, messages: list) -> None:
+        """Rewrite the JSON file with the given messages.
+
+        Args:
+            messages (list): new content of the store
+
+        """
+        with self.lock, self.file_lock:
+            assign_ids(messages, self.last_id())
+            write_json_file(self.path, self.expire(list(messages)))
+
+
+class LogStore(MessageStore):
+    """Append-only store keeping one JSON encoded message per line.
+
+    Adding a message is a single append to the end of the log. Expired
+    messages are dropped by a compaction, which rewrites the log at most
+    once per ``compact_interval`` seconds.
+
+    The messages of the log are kept in an in-memory index, which is brought
+    up to date by reading only the lines appended since the last access (by
+    this or any other process). The indexed log is held open, so its inode
+    can't be reused by a later log and a replaced log is always detected by
+    comparing the inodes of the open file and the path. The timestamp of a message is parsed once,
+    when it enters the index, into a heap of expiry candidates. At most once
+    per ``expire_interval`` seconds the expired messages are popped from the
+    heap and removed from the index, usually by trimming a prefix of it, so
+    reads don't have to check the age of every message.
+
+    If the log does not exist yet but a legacy JSON file is given, the log is
+    created from it, so existing deployments migrate in place.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_age=None,
+        compact_interval=3600,
+        expire_interval=60,
+        legacy_path=None,
+        fsync=False,
+    ):
+        """Create a log store.
+
+        Args:
+            path (str): path of the log file
+            max_age (float): seconds until a message expires, None for never
+            compact_interval (float): minimum seconds between compactions
+            expire_interval (float): minimum seconds between expiry runs
+            legacy_path (str): optional JSON file to migrate from
+            fsync (bool): flush every write to disk before returning
+
+        """
+        super().__init__(max_age)
+        self.path = path
+        self.fsync = fsync
+        self.file_lock = FileLock(path + ".lock")
+        self.compact_interval = compact_interval
+        self.expire_interval = expire_interval
+        self.last_compaction = time.monotonic()
+        self.next_expiry = 0.0
+        self.lock = threading.RLock()
+        self.index = []  # messages of the log that are not known to be expired
+        self.ids = []  # ids of the messages in the index (ascending)
+        self.expiry_heap = []  # (time, id) of the index messages that can expire
+        self.offset = 0  # bytes of the log file that are in the index
+        self.file = None  # the indexed log file, held open
+        self.pid = None  # process that opened self.file
+        self.inode = None
+        self.generation = 0  # number of resets of the index, never reused
+        self.newest_id = 0  # highest id ever seen, never decreases
+        if (
+            legacy_path
+            and not os.path.exists(self.path)
+            and os.path.exists(legacy_path)
+        ):
+            self.import_json(legacy_path)
+
+    def refresh(self) -> None:
+        """Read lines appended to the log since the last refresh into the index.
+
+        If the log was rewritten in the meantime (compaction), the index is
+        rebuilt from scratch. The same happens in a forked process, which must
+        not share the file position of its parent. A partially written last
+        line is left for the next refresh.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.reset(None)
+                return
+            if (
+                self.file is None
+                or self.pid != os.getpid()
+                or stat.st_ino != self.inode
+                or stat.st_size < self.offset
+            ):
+                try:
+                    self.reset(open(self.path, "rb"))
+                except FileNotFoundError:
+                    self.reset(None)
+                    return
+            elif stat.st_size == self.offset:
+                return
+            self.file.seek(self.offset)
+            data = self.file.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                try:
+                    message = serialization.loads(line)
+                except ValueError:
+                    continue
+                if "id" not in message:  # logs written before ids existed
+                    message["id"] = self.newest_id + 1
+                self.newest_id = max(self.newest_id, message["id"])
+                self.index.append(message)
+                self.ids.append(message["id"])
+                if message.get("extra") != "INIT":
+                    heapq.heappush(
+                        self.expiry_heap, (message_time(message), message["id"])
+                    )
+            self.offset += end
+
+    def reset(self, file) -> None:
+        """Empty the index, e.g. because the log file was replaced.
+
+        Args:
+            file (BinaryIO): the new log file opened for reading, None if there
+                is none
+
+        """
+        if self.file is not None:
+            self.file.close()
+        self.index, self.ids, self.expiry_heap = [], [], []
+        self.offset = 0
+        self.generation += 1
+        self.file = file
+        self.pid = os.getpid()
+        self.inode = None if file is None else os.fstat(file.fileno()).st_ino
+        self.next_expiry = 0.0
+
+    def trim(self) -> None:
+        """Remove expired messages from the index, at most once per expire_interval."""
+        if self.max_age is None or time.monotonic() < self.next_expiry:
+            return
+        self.next_expiry = time.monotonic() + self.expire_interval
+        cutoff = time.time() - self.max_age
+        expired = set()
+        while self.expiry_heap and self.expiry_heap[0][0] < cutoff:
+            expired.add(heapq.heappop(self.expiry_heap)[1])
+        if not expired:
+            return
+        count = len(expired)
+        if expired.issuperset(self.ids[:count]):
+            # messages arrived in timestamp order, the expired ones are a prefix
+            del self.index[:count]
+            del self.ids[:count]
+        else:
+            self.index = [m for m in self.index if m["id"] not in expired]
+            self.ids = [m["id"] for m in self.index]
+
+    def expires(self, messages: list):
+        """Return when the index changes next because messages expire.
+
+        The expiry of the oldest message in the index (from the expiry heap,
+        without parsing the messages), but not before the next trim, which is
+        when the index actually drops it.
+
+        Args:
+            messages (list): messages read from the store (not used)
+
+        Returns:
+            float: seconds since the epoch, None if no message expires
+
+        """
+        if self.max_age is None:
+            return None
+        with self.lock:
+            if not self.expiry_heap:
+                return None
+            next_trim = time.time() + max(0.0, self.next_expiry - time.monotonic())
+            return max(self.expiry_heap[0][0] + self.max_age, next_trim)
+
+    def iter_messages(self):
+        """Iterate over the messages of the index.
+
+        Yields:
+            dict: stored messages in insertion order
+
+        """
+        with self.lock:
+            self.refresh()
+            messages = list(self.index)
+        yield from messages
+
+    def read(self) -> list:
+        """Return all messages that are not expired.
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        with self.lock:
+            self.refresh()
+            self.trim()
+            return list(self.index)
+
+    def select(self, since=None, limit=None) -> list:
+        """Return non-expired messages, optionally after a cursor.
+
+        Messages after the cursor are looked up in the index by bisection.
+
+        Args:
+            since (int): only return messages with an id greater than this
+            limit (int): maximum number of messages; the first ones after
+                ``since``, or the latest ones if no cursor is given
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        if since is None:
+            return apply_limit(self.read(), since, limit)
+        with self.lock:
+            self.refresh()
+            self.trim()
+            start = bisect.bisect_right(self.ids, since)
+            return apply_limit(self.index[start:], since, limit)
+
+    def last_id(self) -> int:
+        """Return the id of the newest stored message.
+
+        Returns:
+            int: the newest id, 0 if the store is empty
+
+        """
+        with self.lock:
+            self.refresh()
+            return self.newest_id
+
+    def version(self):
+        """Return the index generation, the read size of the log and the index size.
+
+        Appends grow the log, compactions replace it (which starts a new
+        generation of the index) and expiry shrinks the index, so each of them
+        changes the token. Unlike the inode of a replaced log, a generation is
+        never reused.
+
+        Returns:
+            tuple: the token
+
+        """
+        with self.lock:
+            self.refresh()
+            self.trim()
+            return (self.generation, self.offset, len(self.ids))
+
+    def write_messages(self, messages: list) -> None:
+        """Append new messages to the end of the log with a single write.
+
+        Args:
+            messages (list): messages to add, ids are assigned in place
+
+        """
+        with self.lock, self.file_lock:
+            self.refresh()  # pick up the ids used by other processes
+            assign_ids(messages, self.newest_id)
+            data = b"".join(encode_line(message) for message in messages)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            if time.monotonic() - self.last_compaction >= self.compact_interval:
+                self.refresh()
+                self.trim()
+                self.rewrite(list(self.index))
+
+    def replace(self, messages: list) -> None:
+        """Atomically rewrite the log with the given messages.
+
+        Args:
+            messages (list): new content of the store
+
+        """
+        with self.lock, self.file_lock:
+            self.refresh()
+            self.rewrite(messages)
+
+    def compact(self) -> None:
+        """Drop expired messages from the log file."""
+        with self.lock, self.file_lock:
+            self.refresh()
+            self.next_expiry = 0.0
+            self.trim()
+            self.rewrite(list(self.index))
+
+    def rewrite(self, messages: list) -> None:
+        """Replace the log file (the locks must be held).
+
+        Args:
+            messages (list): new content of the log
+
+        """
+        assign_ids(messages, self.newest_id)
+        messages = self.expire(list(messages))
+        data = b"".join(encode_line(message) for message in messages)
+        self.reset(None)  # the open log can't be replaced on Windows
+        replace_file(self.path, data, self.fsync)
+        self.last_compaction = time.monotonic()
+
+
+class SQLiteStore(MessageStore):
+    """Store keeping the messages in an SQLite database.
+
+    The database runs in WAL mode, so readers in any process don't block the
+    writer and vice versa. Messages are rows keyed by their id, with the
+    timestamp parsed once on insert into an indexed column: selecting the
+    messages after a cursor is a range scan of the primary key and expiry is
+    an indexed DELETE, rather than a rewrite of the whole history.
+
+    Every thread (and process) uses its own connection; the statements are
+    parameterized, so sqlite3 prepares each of them once per connection.
+
+    If the database does not exist yet but a legacy JSON file is given, the
+    database is created from it, so existing deployments migrate in place.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " time REAL NOT NULL,"  # timestamp in seconds since the epoch
+        " init INTEGER NOT NULL,"  # 1 for INIT messages, which never expire
+        " data TEXT NOT NULL)",  # the JSON encoded message
+        "CREATE INDEX IF NOT EXISTS messages_time ON messages (time) WHERE init = 0",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        max_age=None,
+        expire_interval=60,
+        legacy_path=None,
+        fsync=False,
+    ):
+        """Create an SQLite store.
+
+        Args:
+            path (str): path of the database file
+            max_age (float): seconds until a message expires, None for never
+            expire_interval (float): minimum seconds between expiry runs
+            legacy_path (str): optional JSON file to migrate from
+            fsync (bool): sync every transaction to disk (synchronous=FULL)
+
+        """
+        super().__init__(max_age)
+        self.path = path
+        self.expire_interval = expire_interval
+        self.next_expiry = 0.0
+        self.fsync = fsync
+        self.local = threading.local()
+        migrate = (
+            legacy_path
+            and not os.path.exists(self.path)
+            and os.path.exists(legacy_path)
+        )
+        db = self.connection()
+        for statement in self.SCHEMA:
+            db.execute(statement)
+        if migrate:
+            self.import_json(legacy_path)
+
+    def connection(self) -> sqlite3.Connection:
+        """Return the database connection of the calling thread.
+
+        Returns:
+            sqlite3.Connection: the connection, opened on first use (and
+                reopened in a forked process)
+
+        """
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=" + ("FULL" if self.fsync else "NORMAL"))
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    def cutoff(self) -> float:
+        """Return the time before which messages are expired.
+
+        Returns:
+            float: seconds since the epoch, -inf if messages never expire
+
+        """
+        if self.max_age is None:
+            return float("-inf")
+        return time.time() - self.max_age
+
+    def delete_expired(self, db: sqlite3.Connection) -> None:
+        """Delete expired messages, at most once per expire_interval.
+
+        Args:
+            db (sqlite3.Connection): connection of the calling thread
+
+        """
+        if self.max_age is None or time.monotonic() < self.next_expiry:
+            return
+        self.next_expiry = time.monotonic() + self.expire_interval
+        db.execute("DELETE FROM messages WHERE init = 0 AND time < ?", (self.cutoff(),))
+
+    def query(self, sql: str, parameters=()) -> list:
+        """Return the messages selected by a query of the data column.
+
+        Args:
+            sql (str): query returning the id and data of messages
+            parameters (tuple): parameters of the query
+
+        Returns:
+            list: the decoded messages
+
+        """
+        db = self.connection()
+        self.delete_expired(db)
+        return [serialization.loads(data) for _, data in db.execute(sql, parameters)]
+
+    def expires(self, messages: list):
+        """Return when the oldest message that isn't expired yet expires.
+
+        Looked up in the index on the time column, without parsing messages.
+
+        Args:
+            messages (list): messages read from the store (not used)
+
+        Returns:
+            float: seconds since the epoch, None if no message expires
+
+        """
+        if self.max_age is None:
+            return None
+        (oldest,) = (
+            self.connection()
+            .execute(
+                "SELECT MIN(time) FROM messages WHERE init = 0 AND time >= ?",
+                (self.cutoff(),),
+            )
+            .fetchone()
+        )
+        return None if oldest is None else oldest + self.max_age
+
+    def iter_messages(self):
+        """Iterate over all stored messages, including expired ones.
+
+        Yields:
+            dict: stored messages in insertion order
+
+        """
+        yield from self.query("SELECT id, data FROM messages ORDER BY id")
+
+    def read(self) -> list:
+        """Return all messages that are not expired.
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        return self.select()
+
+    def select(self, since=None, limit=None) -> list:
+        """Return non-expired messages, optionally after a cursor.
+
+        Args:
+            since (int): only return messages with an id greater than this
+            limit (int): maximum number of messages; the first ones after
+                ``since``, or the latest ones if no cursor is given
+
+        Returns:
+            list: messages in insertion order
+
+        """
+        if limit is None or limit < 0:
+            limit = -1  # no limit in SQLite
+        where = "(init = 1 OR time >= ?)"
+        if since is not None:
+            return self.query(
+                f"SELECT id, data FROM messages WHERE id > ? AND {where} "
+                "ORDER BY id LIMIT ?",
+                (since, self.cutoff(), limit),
+            )
+        messages = self.query(
+            f"SELECT id, data FROM messages WHERE {where} ORDER BY id DESC LIMIT ?",
+            (self.cutoff(), limit),
+        )
+        messages.reverse()
+        return messages
+
+    def last_id(self) -> int:
+        """Return the highest id ever stored, which doesn't decrease on deletes.
+
+        Returns:
+            int: the newest id, 0 if the store is empty
+
+        """
+        row = (
+            self.connection()
+            .execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def version(self):
+        """Return the newest id and the status of the database and its WAL file.
+
+        Every committed transaction writes to the WAL file (checkpoints write
+        to the database file), so the token changes on writes of any process.
+
+        Returns:
+            tuple: the token
+
+        """
+        token = [self.last_id()]
+        for path in (self.path, self.path + "-wal"):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                token.append(None)
+                continue
+            token.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(token)
+
+    def insert(self, db: sqlite3.Connection, messages: list) -> None:
+        """Insert messages with a single batched statement, numbering them first.
+
+        Args:
+            db (sqlite3.Connection): connection in a write transaction
+            messages (list): messages to insert, ids are assigned in place
+
+        """
+        assign_ids(messages, self.last_id())
+        db.executemany(
+            "INSERT INTO messages (id, time, init, data) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    message["id"],
+                    message_time(message),
+                    message.get("extra") == "INIT",
+                    serialization.dumps(message).decode(),
+                )
+                for message in messages
+            ],
+        )
+
+    def write_messages(self, messages: list) -> None:
+        """Insert new messages in one transaction.
+
+        Args:
+            messages (list): messages to add, ids are assigned in place
+
+        """
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self.insert(db, messages)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def replace(self, messages: list) -> None:
+        """Replace all stored messages in one transaction.
+
+        Args:
+            messages (list): new content of the store
+
+        """
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM messages")
+            self.insert(db, self.expire(list(messages)))
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def compact(self) -> None:
+        """Delete expired messages and shrink the write-ahead log."""
+        db = self.connection()
+        self.next_expiry = 0.0
+        self.delete_expired(db)
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class CommitEntry(object):
+    """Messages of one append call waiting for a group commit."""
+
+    def __init__(self, messages: list):
+        """Create an entry.
+
+        Args:
+            messages (list): the messages to write
+
+        """
+        self.messages = messages
+        self.done = False
+        self.error = None
+
+
+class FileLock(object):
+    """Exclusive lock shared by the threads and processes using a lock file.
+
+    The lock is taken with flock(2) where available; without fcntl (Windows)
+    it only excludes the threads of this process. flock locks belong to the
+    open file, which a forked process shares with its parent, so a forked
+    process opens the lock file again.
+    """
+
+    def __init__(self, path: str):
+        """Create a lock.
+
+        Args:
+            path (str): path of the lock file, created on first use
+
+        """
+        self.path = path
+        self.fd = None
+        self.pid = os.getpid()  # process that created fd and thread_lock
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        """Acquire the lock, blocking until it is available."""
+        if self.pid != os.getpid():
+            self.after_fork()
+        self.thread_lock.acquire()
+        try:
+            if fcntl is not None:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        """Release the lock."""
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            self.thread_lock.release()
+
+    def after_fork(self) -> None:
+        """Drop the lock file and thread lock inherited from the parent process."""
+        self.pid = os.getpid()
+        self.thread_lock = threading.Lock()
+        if self.fd is not None:
+            os.close(self.fd)  # the parent's lock is held by its own descriptor
+            self.fd = None
+
+
+def assign_ids(messages: list, last_id: int) -> None:
+    """Give every message without an id the next free one.
+
+    Args:
+        messages (list): messages to number, modified in place
+        last_id (int): highest id already in use
+
+    """
+    for message in messages:
+        if "id" not in message:
+            last_id += 1
+            message["id"] = last_id
+        else:
+            last_id = max(last_id, message["id"])
+
+
+def apply_limit(messages: list, since=None, limit=None) -> list:
+    """Limit the number of selected messages.
+
+    Args:
+        messages (list): selected messages
+        since (int): cursor of the selection, if any
+        limit (int): maximum number of messages
+
+    Returns:
+        list: the first ``limit`` messages after a cursor, otherwise the latest
+
+    """
+    if limit is None or limit < 0:
+        return messages
+    if since is not None:
+        return messages[:limit]
+    return messages[-limit:] if limit else []
+
+
+def message_time(message: dict) -> float:
+    """Return the timestamp of a message in seconds since the epoch.
+
+    Unreadable timestamps count as now. Posted messages get a readable one
+    on arrival (see channel.censor_message), so this only applies to
+    messages stored before.
+
+    Args:
+        message (dict): the message
+
+    Returns:
+        float: the timestamp
+
+    """
+    try:
+        return parse_timestamp(message.get("timestamp"))
+    except ValueError:
+        return time.time()
+
+
+def parse_timestamp(timestamp) -> float:
+    """Convert a message timestamp to seconds since the epoch.
+
+    ISO 8601 timestamps without timezone are taken as UTC, numbers as unix
+    timestamps.
+
+    Args:
+        timestamp (str | float): the timestamp of a message
+
+    Raises:
+        ValueError: If the timestamp is unreadable or not finite.
+
+    Returns:
+        float: the timestamp
+
+    """
+    if isinstance(timestamp, (int, float)):
+        try:
+            seconds = float(timestamp)
+        except OverflowError:  # int beyond the range of floats
+            seconds = math.inf
+        if not math.isfinite(seconds):
+            raise ValueError("Timestamp is not finite")
+        return seconds
+    parsed = datetime.fromisoformat(str(timestamp).rstrip("Z"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def filter_old_messages(messages: list, max_age=None) -> list:
+    """Filter messages by age. Messages with extra "INIT" never expire.
+
+    Args:
+        messages (list): all messages
+        max_age (float): seconds until a message expires, None for never
+
+    Returns:
+        list: filtered messages
+
+    """
+    if max_age is None:
+        return list(messages)
+    cutoff = time.time() - max_age
+    return [
+        message
+        for message in messages
+        if message.get("extra") == "INIT" or message_time(message) >= cutoff
+    ]
+
+
+def encode_line(message: dict) -> bytes:
+    """Encode a message as a single line of the log.
+
+    Args:
+        message (dict): message to encode
+
+    Returns:
+        bytes: JSON encoded message terminated by a newline
+
+    """
+    return serialization.dumps(message) + b"\n"
+
+
+def read_json_file(path: str) -> list:
+    """Read a list of messages from a JSON file.
+
+    Args:
+        path (str): path of the JSON file
+
+    Returns:
+        list: messages from the file, or an empty list if file not found.
+
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        try:
+            return serialization.loads(f.read())
+        except ValueError:
+            return []
+
+
+def write_json_file(path: str, messages: list) -> None:
+    """Atomically write a list of messages to a JSON file.
+
+    Args:
+        path (str): path of the JSON file
+        messages (list): messages to write
+
+    """
+    replace_file(path, serialization.dumps(messages))
+
+
+def replace_file(path: str, data, fsync=False) -> None:
+    """Atomically replace the content of a file.
+
+    The data is written to a temporary file, which is then renamed, so
+    readers see either the old or the new content, never a partial one.
+
+    Args:
+        path (str): path of the file
+        data (bytes | str): new content
+        fsync (bool): flush the data to disk before renaming
+
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,336 @@
+"""metrics.py - request instrumentation and Prometheus /metrics of hub, channel and client."""
+
+import bisect
+import contextlib
+import threading
+import time
+
+from flask import g, request
+
+METRICS_ENABLED = True  # collect metrics and serve /metrics, False: all are no-ops
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+NULL_TIMER = contextlib.nullcontext()
+
+
+class Registry(object):
+    """The metrics of a process, rendered in the Prometheus text format.
+
+    Besides metrics updated while the process runs, collectors can provide
+    values that are computed when the metrics are rendered (e.g. from the
+    statistics of a cache).
+    """
+
+    def __init__(self):
+        """Create an empty registry."""
+        self.metrics = {}  # name -> Metric
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, or return the one registered under the same name.
+
+        Args:
+            metric (Metric): the metric
+
+        Returns:
+            Metric: the registered metric
+
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def add_collector(self, collector) -> None:
+        """Add a collector.
+
+        Args:
+            collector (callable): returns an iterable of (name, type, help,
+                samples) tuples, samples being (labels dict, value) pairs
+
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: the metrics
+
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for collector in collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """Base class of metrics with values per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels=(), registry=None):
+        """Create a metric and register it.
+
+        Args:
+            name (str): name of the metric
+            documentation (str): help text
+            labels (tuple): names of the labels
+            registry (Registry): defaults to REGISTRY
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}  # tuple of label values -> value
+        self.lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def render(self) -> list:
+        """Return the lines of the metric in the Prometheus text format.
+
+        Returns:
+            list: the lines
+
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines += self.samples(dict(zip(self.labels, label_values)), value)
+        return lines
+
+    def samples(self, labels: dict, value) -> list:
+        """Return the sample lines of one combination of label values.
+
+        Args:
+            labels (dict): label names mapped to values
+            value (Any): the value
+
+        Returns:
+            list: the lines
+
+        """
+        return [f"{self.name}{format_labels(labels)} {value}"]
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of requests."""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1) -> None:
+        """Increment the counter.
+
+        Args:
+            *label_values: values of the labels, in order
+            amount (float): the increment
+
+        """
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Histogram(Metric):
+    """Distribution of durations in seconds, counted in BUCKETS."""
+
+    kind = "histogram"
+
+    def observe(self, seconds: float, *label_values) -> None:
+        """Count an observed duration.
+
+        Args:
+            seconds (float): the duration
+            *label_values: values of the labels, in order
+
+        """
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                # counts per bucket (the last one is +Inf), sum, count
+                entry = self.values[label_values] = [0] * (len(BUCKETS) + 1) + [0, 0]
+            entry[index] += 1
+            entry[-2] += seconds
+            entry[-1] += 1
+
+    def time(self, *label_values):
+        """Return a context manager observing the duration of its block.
+
+        Args:
+            *label_values: values of the labels, in order
+
+        Returns:
+            contextlib.AbstractContextManager: the timer, a no-op if disabled
+
+        """
+        if not METRICS_ENABLED:
+            return NULL_TIMER
+        return Timer(self, label_values)
+
+    def samples(self, labels: dict, value) -> list:
+        """Return the bucket, sum and count lines of one combination of labels.
+
+        Args:
+            labels (dict): label names mapped to values
+            value (list): counts per bucket, sum and count
+
+        Returns:
+            list: the lines
+
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), value):
+            cumulative += count
+            bucket_labels = format_labels(dict(labels, le=str(bound)))
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {value[-2]}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {value[-1]}")
+        return lines
+
+
+class Timer(object):
+    """Context manager observing the duration of its block in a Histogram."""
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        """Create a timer.
+
+        Args:
+            histogram (Histogram): the histogram
+            label_values (tuple): values of its labels
+
+        """
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = None
+
+    def __enter__(self):
+        """Start the timer."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Observe the duration since the start."""
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+def format_labels(labels: dict) -> str:
+    """Format labels like {name="value",...}.
+
+    Args:
+        labels (dict): label names mapped to values
+
+    Returns:
+        str: the formatted labels, empty if there are none
+
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Duration of handled requests.",
+    ("app", "method", "route"),
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Handled requests by status code.",
+    ("app", "method", "route", "status"),
+)
+
+
+def instrument(app, name: str, authorize=None) -> None:
+    """Record the duration and status of all requests of an app and add /metrics.
+
+    Requests are labeled with their route (the URL rule, "unmatched" for
+    unknown URLs), so the number of label values stays bounded.
+
+    Args:
+        app (flask.Flask): the app
+        name (str): value of the "app" label
+        authorize (callable): called with the request of /metrics, returns
+            whether it is authorized; None allows everyone
+
+    """
+
+    @app.before_request
+    def start_request_timer():
+        if METRICS_ENABLED:
+            g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start, name, request.method, route
+            )
+            REQUESTS.inc(name, request.method, route, str(response.status_code))
+        return response
+
+    def metrics_endpoint():
+        if not METRICS_ENABLED:
+            return "Metrics are disabled", 404
+        if authorize is not None and not authorize(request):
+            return "Invalid authorization", 400
+        return app.response_class(
+            REGISTRY.render(), mimetype="text/plain; version=0.0.4"
+        )
+
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
+
+
+def cache_collector(caches: dict):
+    """Return a collector of the statistics of caches.
+
+    Args:
+        caches (dict): names mapped to caches with a ``stats`` method (see
+            cache.TTLCache)
+
+    Returns:
+        callable: the collector, see Registry.add_collector
+
+    """
+
+    def collect():
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        for key, kind, documentation in (
+            ("entries", "gauge", "Entries of the cache."),
+            ("hits", "counter", "Lookups answered by the cache."),
+            ("misses", "counter", "Lookups not answered by the cache."),
+        ):
+            yield (
+                f"cache_{key}" if kind == "gauge" else f"cache_{key}_total",
+                kind,
+                documentation,
+                [({"cache": name}, s[key]) for name, s in stats.items()],
+            )
+
+    return collect
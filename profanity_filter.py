@@ -0,0 +1,270 @@
+"""profanity_filter.py - precompiled drop-in replacement for better_profanity's censor."""
+
+import functools
+
+from better_profanity import profanity as default_profanity
+from better_profanity.constants import ALLOWED_CHARACTERS
+
+DEAD = frozenset()  # automaton state that can't lead to a swear word anymore
+
+
+class ProfanityFilter(object):
+    """Censor swear words like better_profanity, using a precompiled automaton.
+
+    better_profanity compares every word of a text with each of its ~900
+    swear words, expanding the leetspeak variants (e.g. "@" or "4" for "a")
+    on every comparison. Here the swear words are compiled once into a trie
+    whose edges accept all variants of a character. Walking it is a subset
+    construction whose states are created on demand and cached, so a word is
+    matched in a single pass over its characters. The tokenization and the
+    handling of swear words spanning several words are the same as in
+    better_profanity, so ``censor`` returns identical results.
+
+    Only single character substitutions (as in better_profanity's default
+    CHARS_MAPPING) are supported.
+    """
+
+    def __init__(self, words, char_map, max_combinations=1, name_cache_size=4096):
+        """Compile the swear words.
+
+        Args:
+            words (Iterable): the swear words
+            char_map (dict): characters mapped to all their accepted variants
+            max_combinations (int): maximum number of words in a swear word
+            name_cache_size (int): number of cached results of censor_name
+
+        """
+        # accepted[c] = characters of the swear words that c can stand for
+        self.accepted = {}
+        for char, variants in char_map.items():
+            for variant in variants:
+                self.accepted.setdefault(variant, set()).add(char)
+        for char in list(self.accepted):
+            if char not in char_map:
+                self.accepted[char].add(char)
+        self.children = [{}]  # trie nodes, node 0 is the root
+        self.terminals = set()
+        for word in words:
+            node = 0
+            for char in word.lower():
+                if char not in self.children[node]:
+                    self.children[node][char] = len(self.children)
+                    self.children.append({})
+                node = self.children[node][char]
+            self.terminals.add(node)
+        self.start = frozenset([0])
+        self.transitions = {}
+        self.max_combinations = max_combinations
+        self.censor_name = functools.lru_cache(maxsize=name_cache_size)(self.censor)
+
+    @classmethod
+    def from_profanity(cls, profanity=None, **kwargs):
+        """Compile the swear words loaded into a better_profanity instance.
+
+        Args:
+            profanity (better_profanity.Profanity): defaults to the
+                module-level instance of better_profanity
+            **kwargs: further arguments of ProfanityFilter
+
+        Returns:
+            ProfanityFilter: the compiled filter
+
+        """
+        profanity = profanity or default_profanity
+        if not profanity.CENSOR_WORDSET:
+            profanity.load_censor_words()
+        return cls(
+            [str(word) for word in profanity.CENSOR_WORDSET],
+            profanity.CHARS_MAPPING,
+            profanity.MAX_NUMBER_COMBINATIONS,
+            **kwargs,
+        )
+
+    def step(self, state: frozenset, char: str) -> frozenset:
+        """Return the automaton state after reading a character.
+
+        Args:
+            state (frozenset): trie nodes reached so far
+            char (str): the next (lower case) character
+
+        Returns:
+            frozenset: trie nodes reached after the character
+
+        """
+        key = (state, char)
+        result = self.transitions.get(key)
+        if result is not None:
+            return result
+        chars = self.accepted.get(char, (char,))
+        result = frozenset(
+            self.children[node][c]
+            for node in state
+            for c in chars
+            if c in self.children[node]
+        )
+        if result:  # don't remember transitions into the dead state
+            self.transitions[key] = result
+        return result or DEAD
+
+    def is_swear_word(self, word: str) -> bool:
+        """Return whether a word is one of the swear words or a variant of it.
+
+        Args:
+            word (str): the word
+
+        Returns:
+            bool: True if the word has to be censored
+
+        """
+        state = self.start
+        for char in word.lower():
+            state = self.step(state, char)
+            if state is DEAD:
+                return False
+        return not self.terminals.isdisjoint(state)
+
+    def censor(self, text, censor_char="*") -> str:
+        """Replace the swear words in the text with four ``censor_char``.
+
+        Args:
+            text (str): the text
+            censor_char (str): the replacement character
+
+        Returns:
+            str: the censored text
+
+        """
+        if not isinstance(text, str):
+            text = str(text)
+        if not isinstance(censor_char, str):
+            censor_char = str(censor_char)
+        replacement = censor_char * 4
+        censored_text = ""
+        cur_word = ""
+        skip_index = -1
+        next_words_indices = []
+        start_idx_of_next_word = self.start_of_next_word(text, 0)
+
+        # If there are no words in the text, return the raw text without parsing
+        if start_idx_of_next_word >= len(text) - 1:
+            return text
+
+        # Left strip the text, to avoid inaccurate parsing
+        if start_idx_of_next_word > 0:
+            censored_text = text[:start_idx_of_next_word]
+            text = text[start_idx_of_next_word:]
+
+        for index, char in enumerate(text):
+            if index < skip_index:
+                continue
+            if char in ALLOWED_CHARACTERS:
+                cur_word += char
+                continue
+
+            # Skip continuous non-allowed characters
+            if cur_word.strip() == "":
+                censored_text += char
+                cur_word = ""
+                continue
+
+            # Check if the current word combined with the next ones is a swear word
+            if not next_words_indices:
+                next_words_indices = self.next_words(text, index, self.max_combinations)
+            else:
+                del next_words_indices[:2]
+                if next_words_indices and next_words_indices[-1][0] != "":
+                    next_words_indices += self.next_words(
+                        text, next_words_indices[-1][1], 1
+                    )
+            end_index = self.swear_word_end(cur_word, next_words_indices)
+            if end_index is not None:
+                cur_word = replacement
+                skip_index = end_index
+                char = ""
+                next_words_indices = []
+
+            if self.is_swear_word(cur_word):
+                cur_word = replacement
+
+            censored_text += cur_word + char
+            cur_word = ""
+
+        # Final check
+        if cur_word != "" and skip_index < len(text) - 1:
+            if self.is_swear_word(cur_word):
+                cur_word = replacement
+            censored_text += cur_word
+        return censored_text
+
+    def swear_word_end(self, cur_word: str, words_indices: list):
+        """Check whether the current word and the next ones form a swear word.
+
+        Args:
+            cur_word (str): the current word
+            words_indices (list): pairs of the following words, without and
+                with the separators before them, and their end indices
+
+        Returns:
+            int: end index of the swear word, or None if there is none
+
+        """
+        full_word = cur_word
+        full_word_with_separators = cur_word
+        for index in range(0, len(words_indices), 2):
+            single_word, end_index = words_indices[index]
+            word_with_separators, _ = words_indices[index + 1]
+            if single_word == "":
+                continue
+            full_word += single_word
+            full_word_with_separators += word_with_separators
+            if self.is_swear_word(full_word) or self.is_swear_word(
+                full_word_with_separators
+            ):
+                return end_index
+        return None
+
+    def start_of_next_word(self, text: str, start_idx: int) -> int:
+        """Return the index of the first character of the next word.
+
+        Args:
+            text (str): the text
+            start_idx (int): index to start searching at
+
+        Returns:
+            int: the index, or the length of the text if there is none
+
+        """
+        for index in range(start_idx, len(text)):
+            if text[index] in ALLOWED_CHARACTERS:
+                return index
+        return len(text)
+
+    def next_words(self, text: str, start_idx: int, num_of_next_words=1) -> list:
+        """Return the next words, without and with separators, and their end index.
+
+        Args:
+            text (str): the text
+            start_idx (int): index to start searching at
+            num_of_next_words (int): number of words to return
+
+        Returns:
+            list: pairs of (word, end index) and (separators + word, end index)
+
+        """
+        start_idx_of_next_word = self.start_of_next_word(text, start_idx)
+        if start_idx_of_next_word >= len(text) - 1:
+            return [("", start_idx_of_next_word), ("", start_idx_of_next_word)]
+        end_index = start_idx_of_next_word
+        for end_index in range(start_idx_of_next_word, len(text)):
+            if text[end_index] not in ALLOWED_CHARACTERS:
+                break
+        next_word = text[start_idx_of_next_word:end_index]
+        if text[end_index] in ALLOWED_CHARACTERS:  # word ends the text
+            next_word = text[start_idx_of_next_word : end_index + 1]
+        words = [
+            (next_word, end_index),
+            (text[start_idx:start_idx_of_next_word] + next_word, end_index),
+        ]
+        if num_of_next_words > 1:
+            words.extend(self.next_words(text, end_index, num_of_next_words - 1))
+        return words
@@ -0,0 +1,197 @@
+"""profiler.py - opt-in profiling of sampled requests, aggregated per process."""
+
+import cProfile
+import functools
+import marshal
+import os
+import profile as python_profile
+import pstats
+import sys
+import threading
+import time
+
+if sys.version_info >= (3, 12):
+    # cProfile uses sys.monitoring, which covers every thread of the process:
+    # concurrent calls would run under the profiler and end up in the profile.
+    # The pure Python profiler (sys.setprofile) only covers the calling thread.
+    Profile = python_profile.Profile
+else:
+    Profile = cProfile.Profile  # profiles the calling thread
+
+
+class SamplingProfiler(object):
+    """Profile every n-th call of a function (or calls that ask for it).
+
+    The profiles of all sampled calls are added up, so the report shows
+    where the time of the profiled function went on average. Calls that are
+    not sampled only cost a counter increment. Only the thread of a sampled
+    call is profiled, so calls running concurrently in other threads don't
+    end up in the profile.
+
+    From Python 3.12 on, this takes the pure Python profiler, which makes
+    sampled calls several times slower than cProfile (their absolute times
+    are inflated, the proportions hold). sys.setprofile is built on the
+    interpreter-wide sys.monitoring there, so concurrent calls in other
+    threads aren't profiled but still run slower while a sampled call is
+    profiled; keep the sample rate low.
+
+    With a ``path`` the aggregated profile is written there (in the pstats
+    format, with the process id appended to the name) after every sampled
+    call, so it can be inspected with ``python -m pstats`` or snakeviz.
+    """
+
+    def __init__(self, sample_rate=0, path=None):
+        """Create a profiler.
+
+        Args:
+            sample_rate (int): profile 1 in ``sample_rate`` calls, 0 profiles
+                only calls that force it
+            path (str): optional file to dump the aggregated profile to
+
+        """
+        self.sample_rate = sample_rate
+        self.path = path
+        self.calls = 0
+        self.profiled = 0
+        self.skipped = 0  # sampled calls while another profiler was active
+        self.seconds = 0.0
+        self.stats = None
+        self.lock = threading.Lock()
+
+    def sample(self, force=False) -> bool:
+        """Return whether the current call should be profiled.
+
+        Args:
+            force (bool): profile the call regardless of the sample rate
+
+        Returns:
+            bool: True if the call is sampled
+
+        """
+        with self.lock:
+            self.calls += 1
+            return force or bool(
+                self.sample_rate and self.calls % self.sample_rate == 0
+            )
+
+    def call(self, force, function, *args, **kwargs):
+        """Call a function, profiling it if the call is sampled.
+
+        Args:
+            force (bool): profile the call regardless of the sample rate
+            function (callable): the function
+            *args: its positional arguments
+            **kwargs: its keyword arguments
+
+        Returns:
+            Any: the result of the function
+
+        """
+        if not self.sample(force):
+            return function(*args, **kwargs)
+        if sys.getprofile() is not None:  # another profiler in this thread
+            with self.lock:
+                self.skipped += 1
+            return function(*args, **kwargs)
+        profile = Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            self.add(profile, time.perf_counter() - start)
+
+    def sampled(self, force=None):
+        """Return a decorator profiling sampled calls of a function.
+
+        Args:
+            force (callable): called without arguments before every call,
+                returns whether the call must be profiled
+
+        Returns:
+            callable: the decorator
+
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                sampled = force is not None and force()
+                return self.call(sampled, function, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add(self, profile: cProfile.Profile, seconds: float) -> None:
+        """Add the profile of a call to the aggregate (and dump it).
+
+        Args:
+            profile (Profile): the finished profile
+            seconds (float): wall clock duration of the call
+
+        """
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+            self.seconds += seconds
+            if self.path:
+                self.dump("{}.{}".format(self.path, os.getpid()))
+
+    def dump(self, path: str) -> None:
+        """Atomically write the aggregated profile in the pstats format.
+
+        Args:
+            path (str): the file
+
+        """
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            marshal.dump(self.stats.stats, f)
+        os.replace(tmp_path, path)
+
+    def report(self, limit=30, sort="cumulative") -> dict:
+        """Return the hot spots of the profiled calls.
+
+        Args:
+            limit (int): maximum number of functions
+            sort (str): pstats sort key, e.g. "cumulative", "tottime" or "calls"
+
+        Returns:
+            dict: counters and the top functions with their number of calls
+                and total/cumulative seconds (summed over all profiled calls)
+
+        """
+        with self.lock:
+            result = {
+                "calls": self.calls,
+                "profiled": self.profiled,
+                "skipped": self.skipped,
+                "sample_rate": self.sample_rate,
+                "seconds": round(self.seconds, 6),
+                "functions": [],
+            }
+            if self.stats is None:
+                return result
+            self.stats.sort_stats(sort)
+            for func in self.stats.fcn_list[:limit]:
+                primitive, calls, total, cumulative, _ = self.stats.stats[func]
+                result["functions"].append(
+                    {
+                        "function": pstats.func_std_string(func),
+                        "calls": calls,
+                        "primitive_calls": primitive,
+                        "total_seconds": round(total, 6),
+                        "cumulative_seconds": round(cumulative, 6),
+                    }
+                )
+        return result
+
+    def reset(self) -> None:
+        """Forget all profiles and counters."""
+        with self.lock:
+            self.calls = self.profiled = self.skipped = 0
+            self.seconds = 0.0
+            self.stats = None
@@ -0,0 +1,199 @@
+"""serialization.py - fast JSON (orjson if installed) and optional MessagePack encoding.
+
+The output of ``dumps`` is byte-identical to the standard library's
+``json.dumps(obj, separators=(",", ":"), sort_keys=sort_keys)`` (ASCII only,
+other characters escaped), which is what Flask sends, and ``loads`` returns the same
+values as ``json.loads``. orjson is only used where it gives the same result;
+integers beyond 64 bit, NaN, infinity and floats that orjson writes in
+another notation are handled by the standard library. The exception are NaN
+and infinity created in Python (not decoded by ``loads``), which orjson
+writes as null instead of the invalid JSON ``NaN``/``Infinity``.
+"""
+
+import json
+import math
+import re
+
+try:  # optional, the standard library is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # optional, Accept: application/msgpack is answered with JSON without it
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+# the checks below search the JSON with every digit replaced by 0 (faster than
+# a regular expression), false positives only cost the slower json module
+DIGITS = bytes.maketrans(b"123456789", b"000000000")
+# integers orjson would parse as floats (more than 64 bit)
+LONG_NUMBER = re.compile(r"\d{19}")
+LONG_NUMBER_BYTES = b"0" * 19
+# floats orjson writes differently (1e16 instead of 1e+16, 0.00001 instead of 1e-05)
+ORJSON_FLOATS = (b"0e", b"0.0000")
+NON_ASCII = re.compile("[^\x00-\x7e]")
+if orjson is not None:
+    # types json.dumps refuses (or encodes as their base type) go to json
+    ORJSON_OPTIONS = (
+        orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_SUBCLASS
+    )
+    SORT_KEYS = orjson.OPT_SORT_KEYS
+
+
+class NonFiniteFloat(float):
+    """NaN or infinity, which orjson would write as null (it refuses the subclass)."""
+
+
+def parse_float(text: str) -> float:
+    """Parse a JSON number with a fraction or exponent.
+
+    Args:
+        text (str): the number
+
+    Returns:
+        float: the value, a NonFiniteFloat if it overflows
+
+    """
+    value = float(text)
+    return value if math.isfinite(value) else NonFiniteFloat(value)
+
+
+def loads(data):
+    """Decode a JSON document.
+
+    Args:
+        data (bytes | str): the document
+
+    Raises:
+        ValueError: if the document is invalid (json.JSONDecodeError)
+
+    Returns:
+        Any: the decoded value
+
+    """
+    if orjson is not None:
+        if isinstance(data, str):
+            long_number = LONG_NUMBER.search(data)
+        else:
+            long_number = LONG_NUMBER_BYTES in data.translate(DIGITS)
+        if not long_number:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass  # invalid, or NaN/infinity: let json decide
+    return json.loads(data, parse_float=parse_float, parse_constant=NonFiniteFloat)
+
+
+def escape(match) -> str:
+    """Return the JSON escape of a character, as json.dumps(ensure_ascii=True) does.
+
+    Args:
+        match (re.Match): the character
+
+    Returns:
+        str: the escape, a surrogate pair for characters beyond U+FFFF
+
+    """
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(
+            0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF)
+        )
+    return "\\u{:04x}".format(code)
+
+
+def dumps(obj, sort_keys=False) -> bytes:
+    """Encode a value as compact ASCII JSON.
+
+    Args:
+        obj (Any): the value
+        sort_keys (bool): sort the keys of objects
+
+    Returns:
+        bytes: the same bytes as json.dumps(obj, separators=(",", ":"),
+            sort_keys=sort_keys)
+
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(
+                obj, option=ORJSON_OPTIONS | (SORT_KEYS if sort_keys else 0)
+            )
+        except TypeError:  # e.g. big integers, NonFiniteFloat, lone surrogates
+            pass
+        else:
+            digits = data.translate(DIGITS)
+            if not any(pattern in digits for pattern in ORJSON_FLOATS):
+                if data.isascii() and b"\x7f" not in data:
+                    return data
+                # non-ASCII characters can only be part of strings
+                return NON_ASCII.sub(escape, data.decode()).encode()
+    return json.dumps(obj, separators=(",", ":"), sort_keys=sort_keys).encode()
+
+
+def choose_format(request) -> str:
+    """Choose the format of a response from the Accept header.
+
+    Args:
+        request (flask.Request): the request
+
+    Returns:
+        str: MSGPACK if the client prefers it (and msgpack is installed),
+            JSON otherwise
+
+    """
+    if msgpack is None:
+        return JSON
+    accepted = request.accept_mimetypes
+    if accepted[MSGPACK] > accepted[JSON]:
+        return MSGPACK
+    return JSON
+
+
+def encode(obj, mimetype: str) -> bytes:
+    """Encode a response body in a format chosen by choose_format.
+
+    JSON is encoded like Flask's jsonify: sorted keys and a final newline.
+
+    Args:
+        obj (Any): the value
+        mimetype (str): JSON or MSGPACK
+
+    Returns:
+        bytes: the body
+
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb(obj)
+    return dumps(obj, sort_keys=True) + b"\n"
+
+
+def decode(data: bytes, mimetype: str):
+    """Decode a request or response body.
+
+    Args:
+        data (bytes): the body
+        mimetype (str): its type, MSGPACK or (any other) JSON
+
+    Raises:
+        ValueError: if the body is invalid or msgpack isn't installed
+
+    Returns:
+        Any: the decoded value
+
+    """
+    if mimetype == MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        try:
+            return msgpack.unpackb(data)
+        except Exception as e:  # msgpack raises several unrelated types
+            raise ValueError(f"Invalid msgpack: {e}")
+    return loads(data)